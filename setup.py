@@ -32,6 +32,7 @@ setup(
         'pyramid_simpleauth',
         'pyramid_torque_engine',
         'pyramid_postmark',
+        'repoze.lru',
         'transaction',
         'zope.interface'
     ],
@@ -11,7 +11,10 @@ from pyramid import authorization
 from pyramid import security
 from pyramid.settings import asbool
 
+import channels as ch
 import notification as n
+import schedule
+import sender as s
 
 from . import auth
 
@@ -35,6 +38,11 @@ class IncludeMe(object):
 
         # Dispatch the notifications.
         config.add_request_method(n.dispatch_notifications, 'dispatch_notifications', reify=True)
+        config.registry.notification_dispatcher = n.NotificationDispatcher(config.registry)
+
+        # Work out when the notifications are due.
+        settings = config.get_settings()
+        config.registry.notification_scheduler = schedule.Scheduler.from_settings(settings)
 
         # Adds a notification to the resource.
         config.add_directive('add_notification', self.add_notification)
@@ -47,8 +55,21 @@ class IncludeMe(object):
         # Operator user to receive admin related emails.
         config.add_request_method(n.get_operator_user, 'operator_user', reify=True)
 
+        # Authenticated user's unread notification count.
+        config.add_request_method(n.get_unread_notification_count,
+                'unread_notification_count', reify=True)
+
         # Email sender.
         config.include('pyramid_postmark')
+        config.add_request_method(s.get_notification_sender, 'notification_sender', reify=True)
+        config.add_request_method(n.get_notification_render_cache,
+                'notification_render_cache', reify=True)
+
+        # Channels to deliver the dispatches through.
+        config.registry.notification_channels = {}
+        config.add_directive('add_notification_channel', ch.add_notification_channel)
+        for name, factory in ch.DEFAULT_CHANNELS.items():
+            ch.add_notification_channel(config, name, factory)
 
         # Expose webhook views to notifications such as single / batch emails / sms's.
         config.add_route('notification_single', '/notifications/single')
@@ -59,5 +80,19 @@ class IncludeMe(object):
         config.add_view(n.notification_batch_view, renderer='json',
                 request_method='POST', route_name='notification_batch')
 
+        # List a user's notifications.
+        config.add_route('notification_inbox', '/notifications/inbox')
+        config.add_view(n.notification_inbox_view, renderer='json',
+                request_method='GET', route_name='notification_inbox')
+
+        # Mark notifications as read, either a list of them or all of a user's.
+        config.add_route('notification_read', '/notifications/read')
+        config.add_view(n.notification_read_view, renderer='json',
+                request_method='POST', route_name='notification_read')
+
+        config.add_route('notification_read_all', '/notifications/read_all')
+        config.add_view(n.notification_read_all_view, renderer='json',
+                request_method='POST', route_name='notification_read_all')
+
 
 includeme = IncludeMe().__call__
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+"""Provides the channels notification dispatches are delivered through and
+  an ``add_notification_channel`` directive to register more of them.
+"""
+
+__all__ = [
+    'Channel',
+    'EmailChannel',
+    'SmsChannel',
+    'WebhookChannel',
+    'InAppChannel',
+    'DEFAULT_CHANNELS',
+    'RateLimited',
+    'RateLimiter',
+    'UnknownChannel',
+    'add_notification_channel',
+    'get_notification_channel',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+from pyramid import renderers
+from requests import adapters
+
+from . import repo
+
+import copy
+import json
+import requests
+import time
+
+TWILIO_MESSAGES_URL = 'https://api.twilio.com/2010-04-01/Accounts/{0}/Messages.json'
+
+# How long, in seconds, a request blocks for a rate limit before deferring
+# instead. Requests don't block by default, the executer paces its posts.
+RATE_LIMIT_MAX_WAIT = 0
+
+
+class RateLimited(Exception):
+    """Raised when a message can't be sent within the max wait, with how
+      many seconds to wait before trying again.
+    """
+
+    def __init__(self, key, wait):
+        self.key = key
+        self.wait = wait
+        super(RateLimited, self).__init__(
+                'Rate limited on {0} for {1:.1f}s'.format(key, wait))
+
+
+class UnknownChannel(LookupError):
+    """Raised when there's no channel registered for a dispatch's category."""
+
+
+class RateLimiter(object):
+    """A token bucket per key, kept in the db so that it's shared by all of
+      the processes. Blocks until there's a token, or raises ``RateLimited``
+      if that would take longer than ``max_wait`` seconds. Leaves the token
+      for someone else to take if not ``take``.
+    """
+
+    def __init__(self, rate, burst=None, max_wait=RATE_LIMIT_MAX_WAIT, **kwargs):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.max_wait = max_wait
+        self.take = kwargs.get('take', True)
+        self.take_tokens = kwargs.get('take_tokens', repo.take_tokens)
+        self.sleep = kwargs.get('sleep', time.sleep)
+
+    def __call__(self, key, take=None):
+        take = self.take if take is None else take
+        waited = 0
+        while True:
+            wait = self.take_tokens(key, self.rate, self.burst, take=take)
+            if not wait:
+                return
+            if waited + wait > self.max_wait:
+                raise RateLimited(key, wait)
+            self.sleep(wait)
+            waited += wait
+
+
+def get_domain(address):
+    """Get the domain of an email address, e.g.: ``Joe <joe@Example.com>``."""
+
+    if not address or '@' not in address:
+        return None
+    return address.rsplit('@', 1)[1].strip(' >').lower()
+
+
+class Channel(object):
+    """Base class of the channel backends. Each declares whether its
+      dispatches can be sent as a digest, how many messages per second it
+      may send and how many connections it keeps open. These can be
+      overridden with the ``notification.channel.<name>.rate_limit``,
+      ``.burst``, ``.domain_rate_limit`` (per recipient domain) and
+      ``.pool_size`` settings.
+    """
+
+    name = None
+    supports_batching = True
+    # Messages per second, or None for no limit.
+    rate_limit = None
+    domain_rate_limit = None
+    pool_size = 10
+
+    def __init__(self, settings, **kwargs):
+        prefix = 'notification.channel.{0}.'.format(self.name)
+        rate_limit = settings.get(prefix + 'rate_limit')
+        if rate_limit:
+            self.rate_limit = float(rate_limit)
+        domain_rate_limit = settings.get(prefix + 'domain_rate_limit')
+        if domain_rate_limit:
+            self.domain_rate_limit = float(domain_rate_limit)
+        pool_size = settings.get(prefix + 'pool_size')
+        if pool_size:
+            self.pool_size = int(pool_size)
+        self.timeout = float(settings.get('notification.channel_timeout', 30))
+        self.session = self.make_session(kwargs.get('session_cls', requests.Session))
+
+        # Share the rate limits between the processes.
+        limiter_cls = kwargs.get('limiter_cls', RateLimiter)
+        burst = settings.get(prefix + 'burst')
+        burst = float(burst) if burst else None
+        max_wait = float(settings.get('notification.rate_limit_max_wait',
+                RATE_LIMIT_MAX_WAIT))
+        self.limiter = None
+        if self.rate_limit:
+            self.limiter = limiter_cls(self.rate_limit, burst, max_wait)
+        self.domain_limiter = None
+        if self.domain_rate_limit:
+            self.domain_limiter = limiter_cls(self.domain_rate_limit, None, max_wait)
+
+    def make_session(self, session_cls):
+        """Keep a pool of ``pool_size`` keep-alive connections."""
+
+        session = session_cls()
+        adapter = adapters.HTTPAdapter(pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def throttle(self, message):
+        """Wait until sending the message keeps us within the rate limits of
+        the channel and of its recipient's domain. Waits for all of them to
+        have a token before taking any, so a deferred message spends none."""
+
+        limits = []
+        if self.limiter is not None:
+            limits.append((self.limiter, self.name))
+        if self.domain_limiter is not None:
+            domain = get_domain(message['to'])
+            if domain:
+                limits.append((self.domain_limiter, u'{0}:{1}'.format(self.name, domain)))
+
+        for limiter, key in limits:
+            limiter(key, take=False)
+        for limiter, key in limits:
+            limiter(key)
+
+    def send(self, request, message, notification_dispatches):
+        """Deliver the ``message`` dict, with its ``from``, ``to``,
+        ``subject``, ``spec``, ``tmpl_vars`` and ``bcc``. Returns the
+        dispatches that were delivered and are yet to be marked as sent, or
+        raises if they couldn't be. Raises ``RateLimited`` if they should
+        be sent later.
+        """
+
+        self.throttle(message)
+        return self.deliver(request, message, notification_dispatches)
+
+    def deliver(self, request, message, notification_dispatches):
+        raise NotImplementedError
+
+    def cached(self, request, message, render):
+        """Call ``render`` once per ``render_key`` of the message for the
+        duration of the request, if it has one."""
+
+        render_key = message.get('render_key')
+        if render_key is None:
+            return render()
+        cache = request.notification_render_cache
+        key = (self.name,) + render_key
+        value = cache.get(key)
+        if value is None:
+            value = render()
+            cache.put(key, value)
+        return value
+
+    def render(self, request, message):
+        """Render the message body from its template."""
+
+        return self.cached(request, message, lambda: renderers.render(
+                message['spec'], message['tmpl_vars'], request=request))
+
+
+class EmailChannel(Channel):
+    """Renders an email and hands it to the request's notification sender,
+      which marks the dispatches as sent once it's been sent.
+    """
+
+    name = 'email'
+
+    def deliver(self, request, message, notification_dispatches):
+        tmpl_vars = message['tmpl_vars']
+        render = lambda: request.render_email(
+                message['from'],
+                message['to'],
+                message['subject'],
+                message['spec'],
+                tmpl_vars,
+                **tmpl_vars)
+        email = self.cached(request, message, render)
+
+        # A cached email is copied and addressed to this recipient.
+        if message.get('render_key') is not None:
+            email = copy.copy(email)
+            email.to = message['to']
+            email.bcc = tmpl_vars.get('bcc')
+
+        request.notification_sender(email, notification_dispatches)
+        return []
+
+
+class SmsChannel(Channel):
+    """Sends a text message through Twilio. The dispatch view should set
+      ``to`` to the user's phone number, so it can't be recipient
+      independent.
+    """
+
+    name = 'sms'
+    rate_limit = 1
+
+    def __init__(self, settings, **kwargs):
+        super(SmsChannel, self).__init__(settings, **kwargs)
+        self.account_sid = settings.get('twilio.account_sid')
+        self.auth_token = settings.get('twilio.auth_token')
+        self.from_number = settings.get('twilio.from_number')
+        self.url = settings.get('notification.sms_url',
+                TWILIO_MESSAGES_URL.format(self.account_sid))
+
+    def deliver(self, request, message, notification_dispatches):
+        data = {
+            'From': self.from_number,
+            'To': message['to'],
+            'Body': self.render(request, message),
+        }
+        r = self.session.post(self.url, data=data,
+                auth=(self.account_sid, self.auth_token), timeout=self.timeout)
+        r.raise_for_status()
+        return notification_dispatches
+
+
+class WebhookChannel(Channel):
+    """Posts the rendered message as JSON to the url the dispatch view
+      sets as ``to``, so it can't be recipient independent.
+    """
+
+    name = 'webhook'
+
+    def deliver(self, request, message, notification_dispatches):
+        data = {
+            'subject': message['subject'],
+            'body': self.render(request, message),
+            'notification_dispatch_ids': [d.id for d in notification_dispatches],
+        }
+        headers = {'Content-Type': 'application/json'}
+        r = self.session.post(message['to'], data=json.dumps(data),
+                headers=headers, timeout=self.timeout)
+        r.raise_for_status()
+        return notification_dispatches
+
+
+class InAppChannel(Channel):
+    """The notification itself is what's shown in the app, so there's
+      nothing to deliver.
+    """
+
+    name = 'in_app'
+    supports_batching = False
+
+    def deliver(self, request, message, notification_dispatches):
+        return notification_dispatches
+
+
+DEFAULT_CHANNELS = {
+    'email': EmailChannel,
+    'sms': SmsChannel,
+    'webhook': WebhookChannel,
+    'in_app': InAppChannel,
+}
+
+
+def add_notification_channel(config, name, factory):
+    """Register the channel ``factory``, called with the settings, to deliver
+    the dispatches of the ``name`` category."""
+
+    # Unpack.
+    registry = config.registry
+
+    channel = factory(registry.settings)
+    channel.name = name
+    registry.notification_channels[name] = channel
+
+
+def get_notification_channel(request, name):
+    """Gets the channel backend registered for the ``name`` category."""
+
+    # Unpack.
+    registry = request.registry
+
+    channel = registry.notification_channels.get(name)
+    if channel is None:
+        raise UnknownChannel(u'Unknown channel to send the notification: {0}'.format(name))
+    return channel
@@ -4,7 +4,9 @@
 
 __all__ = [
     'add_notification',
-    'AddNotification'
+    'recipient_independent',
+    'AddNotification',
+    'NotificationDispatcher',
 ]
 
 import logging
@@ -13,45 +15,193 @@ logger = logging.getLogger(__name__)
 from pyramid_torque_engine import unpack
 from pyramid_torque_engine import operations as ops
 
+from . import channels
 from . import repo
 from . import util
+from pyramid import exceptions
 from pyramid import path
+from pyramid import renderers
+from pyramid import scripting
 
 from pyramid_simpleauth.model import get_existing_user
 
+try:
+    from mako import exceptions as mako_exceptions
+except ImportError: # pragma: no cover
+    mako_exceptions = None
+
+from dateutil import parser
+from dateutil import tz
+from repoze.lru import LRUCache
+
+import Queue
 import colander
 import datetime
+import itertools
 import pyramid_basemodel as bm
 import requests
 import json
 import os
+import socket
+import threading
+import transaction
+
+# Send the due notifications within the request or after it has committed.
+DISPATCH_MODES = ('sync', 'async')
+
+# What became of a dispatch we tried to send: it was sent, or handed to the
+# sender, it was put off by a rate limit or it failed and will be retried.
+SENT, DEFERRED, FAILED = 'ok', 'deferred', 'failed'
+
+# Process wide cache of the resolved dispatch views, by dotted name.
+RESOLVED_VIEWS = {}
+
+# How many rendered templates and template vars to keep per request.
+RENDER_CACHE_SIZE = 256
+
+# The template vars that are set per recipient, rather than cached.
+RECIPIENT_VARS = ('to', 'bcc')
+
+# What a missing renderer or a missing or broken template raises.
+TEMPLATE_ERRORS = (ValueError, IOError)
+if mako_exceptions is not None:
+    TEMPLATE_ERRORS += (mako_exceptions.MakoException,)
+
+
+def resolve_view(dotted_name):
+    """Resolve the dispatch view, caching it for the life of the process."""
+
+    view = RESOLVED_VIEWS.get(dotted_name)
+    if view is None:
+        view = path.DottedNameResolver().resolve(dotted_name)
+        RESOLVED_VIEWS[dotted_name] = view
+    return view
+
+
+def recipient_independent(view):
+    """Mark a dispatch view whose template vars, and so the rendered
+    template, only depend on the event. They are then worked out once per
+    event and spec for all of the recipients in a request, which only get
+    their own ``to`` and ``bcc`` from their dispatch. Any the view sets are
+    ignored, so views that set ``to`` themselves, e.g.: for sms, can't be
+    recipient independent."""
+
+    view.recipient_independent = True
+    return view
+
+
+def get_notification_render_cache(request):
+    """Get the LRU cache of the template vars and rendered templates of the
+    recipient independent views, which lasts for the request."""
+
+    # Unpack.
+    settings = request.registry.settings
+
+    size = int(settings.get('notification.render_cache_size', RENDER_CACHE_SIZE))
+    return LRUCache(size)
+
+
+def get_template_vars(request, view, context, send_to, event, render_key=None):
+    """Call the dispatch view, or reuse what it returned for the same
+    ``render_key`` if it's recipient independent, without the recipient's
+    ``to`` and ``bcc``."""
+
+    if render_key is None:
+        return view(request, context, send_to, event, event.action)
+
+    cache = request.notification_render_cache
+    key = ('tmpl_vars',) + render_key
+    tmpl_vars = cache.get(key)
+    if tmpl_vars is None:
+        tmpl_vars = view(request, context, send_to, event, event.action)
+        tmpl_vars = dict((k, v) for k, v in tmpl_vars.items()
+                if k not in RECIPIENT_VARS)
+        cache.put(key, tmpl_vars)
+    return dict(tmpl_vars)
+
+
+def get_render_key(view, notification_dispatch, spec):
+    """Get the key to cache the rendering of the dispatch by, if its view is
+    recipient independent."""
+
+    if not getattr(view, 'recipient_independent', False):
+        return None
+    event_id = notification_dispatch.notification.event_id
+    return event_id, notification_dispatch.view, spec
+
+
+def warm_dispatch_mapping(config, dispatch_mapping):
+    """Resolve the views and load the templates of the dispatch mapping when
+    the configuration is committed, so that unknown ones fail at config time
+    rather than on the first send."""
+
+    def warm():
+        for channel, v in dispatch_mapping.items():
+            try:
+                resolve_view(v['view'])
+            except (ImportError, ValueError) as err:
+                raise exceptions.ConfigurationError(
+                        'Notification view {0}: {1}'.format(v['view'], err))
+            for spec in (v.get('single'), v.get('batch')):
+                warm_template(config, spec)
+
+    config.action(None, warm)
+
+
+def warm_template(config, spec):
+    """Check the template exists and load it through its renderer's template
+    lookup, if it has one (e.g.: mako), so that it's compiled up front."""
+
+    if spec is None:
+        return
+    if ':' in spec and not path.AssetResolver().resolve(spec).exists():
+        raise exceptions.ConfigurationError(
+                'Notification template {0} does not exist'.format(spec))
+    helper = renderers.RendererHelper(name=spec, package=config.package,
+            registry=config.registry)
+    try:
+        renderer = helper.renderer
+        lookup = getattr(renderer, 'lookup', None)
+        if lookup is not None:
+            lookup.get_template(renderer.spec)
+    except TEMPLATE_ERRORS as err:
+        raise exceptions.ConfigurationError(
+                'Notification template {0}: {1}'.format(spec, err))
 
 
 def send_from_notification_dispatch(request, notification_dispatch_id):
     """Boilerplate to extract information from the notification
-    dispatch and send an email.
+    dispatch and send an email, returning what became of it or ``False`` if
+    there's no such dispatch.
     Please note that no verification if it should
     be sent is made prior to sending.
     """
 
     lookup = repo.LookupNotificationDispatch()
-    dotted_name_resolver = path.DottedNameResolver()
 
     notification_dispatch = lookup(notification_dispatch_id)
     if not notification_dispatch:
         return False
 
+    return send_notification_dispatch(request, notification_dispatch)
+
+
+def send_notification_dispatch(request, notification_dispatch):
+    """Extract information from the notification dispatch and send it.
+    Returns ``SENT``, ``DEFERRED`` or ``FAILED``."""
+
     # Extract information from the notification dispatch.
     spec = notification_dispatch.single_spec
     send_to = notification_dispatch.address
-    view = dotted_name_resolver.resolve(notification_dispatch.view)
+    view = resolve_view(notification_dispatch.view)
     event = notification_dispatch.notification.event
     bcc = notification_dispatch.bcc
     context = event.parent
     channel = notification_dispatch.category
 
     # Get the template vars.
-    tmpl_vars = view(request, context, send_to, event, event.action)
+    render_key = get_render_key(view, notification_dispatch, spec)
+    tmpl_vars = get_template_vars(request, view, context, send_to, event, render_key)
 
     # Set some defaults for the template vars.
     tmpl_vars.setdefault('data', context)
@@ -65,33 +215,31 @@ def send_from_notification_dispatch(request, notification_dispatch_id):
         tmpl_vars.setdefault('bcc', bcc)
 
     # Extract form tmpl_vars and remove.
-    subject = tmpl_vars['subject']
-    to_ = tmpl_vars['to']
-    from_ = tmpl_vars['from']
-    del tmpl_vars['subject']
-    del tmpl_vars['to']
-    del tmpl_vars['from']
-
-    # Send emails / sms.
-    if channel == 'email':
-        email = request.render_email(
-                from_,
-                to_,
-                subject,
-                spec,
-                tmpl_vars,
-                **tmpl_vars)
-        request.send_email(email)
-    elif channel == 'sms':
-        pass
-    else:
-        raise Exception('Unknown channel to send the notification')
-
-    # Set the sent info in our db.
-    notification_dispatch.sent = datetime.datetime.now()
-    bm.save(notification_dispatch)
+    message = {
+        'subject': tmpl_vars.pop('subject'),
+        'to': tmpl_vars.pop('to'),
+        'from': tmpl_vars.pop('from'),
+        'spec': spec,
+        'tmpl_vars': tmpl_vars,
+        'render_key': render_key,
+    }
+
+    # Send through the channel, which tells us what it's delivered. Record
+    # the failures so they're retried later on and put off the rate limited.
+    try:
+        backend = channels.get_notification_channel(request, channel)
+        sent = backend.send(request, message, [notification_dispatch])
+    except channels.RateLimited as err:
+        repo.defer_dispatches([notification_dispatch.id], err.wait)
+        return DEFERRED
+    except Exception as err:
+        logger.warn('Notification: failed to send dispatch {0}: {1}'.format(
+                notification_dispatch.id, err))
+        repo.mark_dispatches_failed([(notification_dispatch.id, err)])
+        return FAILED
+    repo.mark_dispatches_sent([d.id for d in sent])
 
-    return True
+    return SENT
 
 
 def notification_single_view(request):
@@ -123,59 +271,377 @@ def notification_single_view(request):
 
     # Send the email.
     r = send_from_notification_dispatch(request, notification_dispatch_id)
+    failed = request.notification_sender.flush()
     if not r:
         request.response.status_int = 404
         return {'error': u'Notification dispatch not Found.'}
+    if failed:
+        r = FAILED
 
-    # Return 200.
-    return {'dispatched': 'ok'}
+    # Return 200, as the failures have already been recorded to be retried.
+    return {'dispatched': r}
+
+
+def send_from_notification_dispatches(request, notification_dispatches):
+    """Boilerplate to send the notification dispatches as one digest per
+    user and channel, rendered with the ``batch_spec``, and then mark them
+    all as sent with a single update. Dispatches of channels that don't
+    support batching are sent one by one.
+    Please note that no verification if they should
+    be sent is made prior to sending.
+    """
+
+    # Group the dispatches by user and channel.
+    def by_user_and_channel(notification_dispatch):
+        user_id = notification_dispatch.notification.user_id
+        return user_id, notification_dispatch.category
+    grouped = itertools.groupby(sorted(notification_dispatches,
+            key=by_user_and_channel), by_user_and_channel)
+
+    sent = []
+    failures = []
+
+    for (user_id, channel), user_dispatches in grouped:
+        user_dispatches = list(user_dispatches)
+        try:
+            backend = channels.get_notification_channel(request, channel)
+        except channels.UnknownChannel as err:
+            logger.warn('Notification: failed to send digest to user {0}: {1}'.format(
+                    user_id, err))
+            failures.extend((d.id, err) for d in user_dispatches)
+            continue
+        if not backend.supports_batching:
+            for notification_dispatch in user_dispatches:
+                send_notification_dispatch(request, notification_dispatch)
+            continue
+
+        # Extract the shared information from the first dispatch.
+        first = user_dispatches[0]
+        spec = first.batch_spec
+        send_to = first.address
+        bcc = first.bcc
+
+        # Get the template vars for each of the events.
+        items = []
+        for notification_dispatch in user_dispatches:
+            view = resolve_view(notification_dispatch.view)
+            event = notification_dispatch.notification.event
+            context = event.parent
+            render_key = get_render_key(view, notification_dispatch,
+                    notification_dispatch.batch_spec)
+            item_vars = get_template_vars(request, view, context, send_to, event,
+                    render_key)
+            item_vars.setdefault('data', context)
+            item_vars.setdefault('state_or_action', event.action)
+            item_vars.setdefault('event', event)
+            items.append(item_vars)
+
+        # Set the digest template vars.
+        tmpl_vars = {
+            'items': items,
+            'to': items[0].get('to', send_to),
+            'from': util.extract_from(request),
+            'subject': u'{0} new notifications'.format(len(items)),
+        }
+        # Check if we should add bcc.
+        if bcc:
+            tmpl_vars['bcc'] = bcc
+
+        # Extract form tmpl_vars and remove.
+        message = {
+            'subject': tmpl_vars.pop('subject'),
+            'to': tmpl_vars.pop('to'),
+            'from': tmpl_vars.pop('from'),
+            'spec': spec,
+            'tmpl_vars': tmpl_vars,
+        }
+
+        # Send through the channel, which tells us what it's delivered.
+        try:
+            sent.extend(backend.send(request, message, user_dispatches))
+        except channels.RateLimited as err:
+            repo.defer_dispatches([d.id for d in user_dispatches], err.wait)
+        except Exception as err:
+            logger.warn('Notification: failed to send digest to user {0}: {1}'.format(
+                    user_id, err))
+            failures.extend((d.id, err) for d in user_dispatches)
+
+    # Set the sent info in our db in one go and record the failures.
+    repo.mark_dispatches_sent([d.id for d in sent])
+    repo.mark_dispatches_failed(failures)
+
+    return len(notification_dispatches)
 
 
 def notification_batch_view(request):
-    """View to handle a batch email notification dispatch"""
-    pass
+    """View to handle a batch email notification dispatch. Either takes a
+    list of ``notification_dispatch_ids`` or a ``user_id`` and a ``channel``
+    to send all of the user's due dispatches.
+    """
+
+    class NotificationDispatchIds(colander.SequenceSchema):
+        notification_dispatch_id = colander.SchemaNode(
+            colander.Integer(),
+        )
+
+    class BatchNotificationSchema(colander.Schema):
+        notification_dispatch_ids = NotificationDispatchIds(
+            missing=colander.drop,
+        )
+        user_id = colander.SchemaNode(
+            colander.Integer(),
+            missing=colander.drop,
+        )
+        channel = colander.SchemaNode(
+            colander.String(),
+            missing=u'email',
+        )
+
+    schema = BatchNotificationSchema()
+    lookup = repo.LookupNotificationDispatch()
+
+    # Decode JSON.
+    try:
+        json = request.json
+    except ValueError as err:
+        request.response.status_int = 400
+        return {'JSON error': str(err)}
+
+    # Validate.
+    try:
+        appstruct = schema.deserialize(json)
+    except colander.Invalid as err:
+        request.response.status_int = 400
+        return {'error': err.asdict()}
+
+    # Get the dispatches out of the db in one query.
+    if 'notification_dispatch_ids' in appstruct:
+        ids = appstruct['notification_dispatch_ids']
+        notification_dispatches = lookup.by_ids(ids)
+    elif 'user_id' in appstruct:
+        now = datetime.datetime.now()
+        notification_dispatches = lookup.due_by_user_id(appstruct['user_id'],
+                appstruct['channel'], now)
+    else:
+        request.response.status_int = 400
+        return {'error': u'Either notification_dispatch_ids or user_id is required.'}
+
+    # Send the emails.
+    r = send_from_notification_dispatches(request, notification_dispatches)
+    request.notification_sender.flush()
+    if not r:
+        request.response.status_int = 404
+        return {'error': u'Notification dispatches not Found.'}
+
+    # Return 200.
+    return {'dispatched': r}
+
+
+def notification_read_view(request):
+    """View to mark a list of the authenticated user's notifications as read."""
+
+    class NotificationIds(colander.SequenceSchema):
+        notification_id = colander.SchemaNode(
+            colander.Integer(),
+        )
+
+    class ReadNotificationSchema(colander.Schema):
+        notification_ids = NotificationIds()
+
+    schema = ReadNotificationSchema()
+
+    # Only the user's own notifications can be marked as read.
+    user = request.user
+    if user is None:
+        request.response.status_int = 401
+        return {'error': 'Not authenticated'}
+
+    # Decode JSON.
+    try:
+        json = request.json
+    except ValueError as err:
+        request.response.status_int = 400
+        return {'JSON error': str(err)}
+
+    # Validate.
+    try:
+        appstruct = schema.deserialize(json)
+    except colander.Invalid as err:
+        request.response.status_int = 400
+        return {'error': err.asdict()}
+
+    # Mark them as read in one go.
+    r = repo.mark_notifications_read(appstruct['notification_ids'], user_id=user.id)
+
+    # Return 200.
+    return {'read': r}
+
+
+def notification_read_all_view(request):
+    """View to mark all of the authenticated user's notifications created
+    before a date, now by default, as read. Naive dates are taken as UTC."""
+
+    class ReadAllNotificationSchema(colander.Schema):
+        before = colander.SchemaNode(
+            colander.DateTime(default_tzinfo=None),
+            missing=None,
+        )
+
+    schema = ReadAllNotificationSchema()
+
+    # Unpack.
+    user = request.user
+    if user is None:
+        request.response.status_int = 401
+        return {'error': 'Not authenticated'}
+
+    # Decode JSON.
+    try:
+        json = request.json
+    except ValueError as err:
+        request.response.status_int = 400
+        return {'JSON error': str(err)}
+
+    # Validate.
+    try:
+        appstruct = schema.deserialize(json)
+    except colander.Invalid as err:
+        request.response.status_int = 400
+        return {'error': err.asdict()}
+
+    # The created dates are naive UTC times.
+    before = appstruct['before']
+    if before is not None and before.tzinfo is not None:
+        before = before.astimezone(tz.tzutc()).replace(tzinfo=None)
+
+    # Mark them as read in one go.
+    r = repo.mark_user_notifications_read(user.id, before)
+
+    # Return 200.
+    return {'read': r}
+
+
+def notification_inbox_view(request):
+    """View to page through the authenticated user's notifications, newest
+    first. Takes the ``next`` cursor of the previous page as ``before``."""
+
+    class InboxSchema(colander.Schema):
+        limit = colander.SchemaNode(
+            colander.Integer(),
+            validator=colander.Range(1, 100),
+            missing=50,
+        )
+        unread = colander.SchemaNode(
+            colander.Boolean(),
+            missing=False,
+        )
+        before = colander.SchemaNode(
+            colander.String(),
+            missing=None,
+        )
+
+    schema = InboxSchema()
+    lookup = repo.LookupNotification()
+
+    # Only the user's own notifications are listed.
+    user = request.user
+    if user is None:
+        request.response.status_int = 401
+        return {'error': 'Not authenticated'}
+
+    # Validate.
+    try:
+        appstruct = schema.deserialize(request.GET.mixed())
+    except colander.Invalid as err:
+        request.response.status_int = 400
+        return {'error': err.asdict()}
+
+    # Decode the cursor.
+    before = appstruct['before']
+    if before is not None:
+        try:
+            created, id_ = before.rsplit(',', 1)
+            before = parser.parse(created), int(id_)
+        except ValueError as err:
+            request.response.status_int = 400
+            return {'error': {'before': str(err)}}
+
+    # Get the page.
+    user_id = user.id
+    limit = appstruct['limit']
+    notifications = lookup.inbox(user_id, limit, before, appstruct['unread'])
+    items = []
+    for notification in notifications:
+        item = notification.__json__(request)
+        item['action'] = notification.event.action
+        item['target'] = notification.event.target
+        items.append(item)
+
+    # The cursor of the next page.
+    next_ = None
+    if len(notifications) == limit:
+        last = notifications[-1]
+        next_ = u'{0},{1}'.format(last.created.isoformat(), last.id)
+
+    return {
+        'notifications': items,
+        'unread_count': repo.get_unread_count(user_id),
+        'next': next_,
+    }
 
 
 class AddNotification(object):
-    """Standard boilerplate to add a notification."""
+    """Standard boilerplate to add a notification. If ``coalesce`` is a
+      number of minutes, the notifications about the same context within
+      that window are coalesced until they're delivered.
+    """
 
-    def __init__(self, iface, role, dispatch_mapping, delay=None, bcc=None):
+    def __init__(self, iface, role, dispatch_mapping, delay=None, bcc=None,
+            dispatch_mode='sync', coalesce=None):
         """"""
 
         self.dispatch_mapping = dispatch_mapping
-        self.notification_factory = repo.NotificationFactory
+        self.notification_factory = repo.BulkNotificationFactory
         self.role = role
         self.delay = delay
         self.bcc = bcc
         self.iface = iface
+        self.dispatch_mode = dispatch_mode
+        self.coalesce = coalesce
 
     def __call__(self, request, context, event, op, **kwargs):
         """"""
 
         # Unpack.
         dispatch_mapping = self.dispatch_mapping
-        notification_factory = self.notification_factory(request)
+        notification_factory = self.notification_factory(request,
+                scheduler=request.registry.notification_scheduler)
         delay = self.delay
         bcc = self.bcc
         iface = self.iface
         role = self.role
 
         # Prepare.
-        notifications = []
+        users = []
 
         # get relevant information.
-        interested_users_func = get_roles_mapping(request, iface)
-        interested_users = interested_users_func(request, context)
+        interested_users = get_interested_users(request, iface, context)
         for user in interested_users[role]:
             # Just user is a shorthand for context.user.
             if user == 'user':
                 user = context.user
-            # create the notifications.
-            notification = notification_factory(event, user, dispatch_mapping, delay, bcc)
-            notifications.append(notification)
+            users.append(user)
 
-        # Tries to optimistically send the notification.
-        dispatch_notifications(request, notifications)
+        # create the notifications.
+        notification_ids = notification_factory(event, users, dispatch_mapping, delay, bcc,
+                coalesce=self.coalesce)
+
+        # Tries to optimistically send the notification, either now or
+        # in the background once the transaction has been committed.
+        if self.dispatch_mode == 'async':
+            dispatch_notifications_after_commit(request, notification_ids)
+        else:
+            dispatch_notifications(request, notification_ids)
 
 
 def add_notification(config,
@@ -184,7 +650,12 @@ def add_notification(config,
                      role,
                      dispatch_mapping,
                      delay=None,
-                     bcc=None):
+                     bcc=None,
+                     dispatch_mode='sync',
+                     coalesce=None):
+
+    if dispatch_mode not in DISPATCH_MODES:
+        raise ValueError('Unknown notification dispatch mode {0}'.format(dispatch_mode))
 
     # Unpack.
     _, o, _, s = unpack.constants()
@@ -194,7 +665,11 @@ def add_notification(config,
         'CREATE_NOTIFICATION',
     )
 
-    create_notification_in_db = AddNotification(iface, role, dispatch_mapping, delay, bcc)
+    # Fail early on unknown views and templates.
+    warm_dispatch_mapping(config, dispatch_mapping)
+
+    create_notification_in_db = AddNotification(iface, role, dispatch_mapping, delay, bcc,
+            dispatch_mode, coalesce)
     on(iface, state_or_action_changes, o.CREATE_NOTIFICATION, create_notification_in_db)
 
 
@@ -224,6 +699,21 @@ def get_roles_mapping(request, iface):
     return roles_mapping.get(iface, None)
 
 
+def get_interested_users(request, iface, context):
+    """Gets the users interested in the context by role, using the roles
+    mapping of the resource. The result is memoized for the duration of the
+    request, keyed by the context's current work status so that it's
+    computed again when the context changes state."""
+
+    cache = request.environ.setdefault('notification.interested_users', {})
+    key = (iface, context.__class__, getattr(context, 'id', id(context)),
+            getattr(context, 'work_status', None))
+    if key not in cache:
+        interested_users_func = get_roles_mapping(request, iface)
+        cache[key] = interested_users_func(request, context)
+    return cache[key]
+
+
 def get_operator_user(request, registry=None):
     """We have a special user in our db representing the operator user. Here
       We look them up by username, constructed from the client server name.
@@ -249,19 +739,102 @@ def get_operator_user(request, registry=None):
     return get_existing_user(username=username)
 
 
-def dispatch_notifications(request, notifications):
+def get_unread_notification_count(request):
+    """Gets the authenticated user's unread notification count."""
+
+    user = request.user
+    if user is None:
+        return 0
+    return repo.get_unread_count(user.id)
+
+
+def dispatch_notifications(request, notification_ids):
     """Dispatches a notification directly without waiting for the
     background process."""
 
+    if not notification_ids:
+        return
+
     lookup = repo.LookupNotificationDispatch()
     now = datetime.datetime.now()
 
-    # Loop through the notifications and check if we should send them.
-    for notification in notifications:
-        # Get our create the user preferences.
-        preference = repo.get_or_create_notification_preferences(notification.user)
-        # Check if its due to dispatch, if so, dispatch.
-        for dispatch in lookup.by_notification_id(notification.id):
-            if dispatch.due <= now:
-                send_from_notification_dispatch(request, dispatch.id)
+    # Get all of the due dispatches in one query and send them.
+    for dispatch in lookup.due_by_notification_ids(notification_ids, now):
+        send_notification_dispatch(request, dispatch)
+    request.notification_sender.flush()
+
+
+def dispatch_notifications_after_commit(request, notification_ids):
+    """Hands the due notification dispatches to the background dispatcher
+    once the current transaction has been committed. They're claimed in the
+    same transaction, so the executer woken up by the commit skips them."""
+
+    lookup = repo.LookupNotificationDispatch()
+    dispatcher = request.registry.notification_dispatcher
+    claim = repo.ClaimNotificationDispatches(dispatcher.worker_id)
+    now = datetime.datetime.now()
+
+    # Get the ids of the dispatches that are due and claim them.
+    if not notification_ids:
+        return
+    due = lookup.due_by_notification_ids(notification_ids, now)
+    dispatch_ids = claim.by_ids([dispatch.id for dispatch in due], now)
+    if not dispatch_ids:
+        return
 
+    def after_commit(success, dispatch_ids):
+        if success:
+            dispatcher.enqueue(dispatch_ids)
+    transaction.get().addAfterCommitHook(after_commit, args=(dispatch_ids,))
+
+
+class NotificationDispatcher(object):
+    """Sends notification dispatches from a background thread, outside of
+    the request that created them."""
+
+    def __init__(self, registry, **kwargs):
+        self.registry = registry
+        self.queue = kwargs.get('queue_cls', Queue.Queue)()
+        self.prepare = kwargs.get('prepare', scripting.prepare)
+        self.worker_id = kwargs.get('worker_id', u'{0}:{1}:dispatcher'.format(
+                socket.gethostname(), os.getpid()))
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def enqueue(self, notification_dispatch_ids):
+        """Queue the dispatch ids to be sent, starting the worker if needs be."""
+
+        for notification_dispatch_id in notification_dispatch_ids:
+            self.queue.put(notification_dispatch_id)
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.work)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def work(self):
+        """Send the queued dispatches, forever."""
+
+        while True:
+            notification_dispatch_id = self.queue.get()
+            try:
+                self.send(notification_dispatch_id)
+            except Exception:
+                logger.exception('Notification: failed to send dispatch {0}'.format(
+                        notification_dispatch_id))
+            finally:
+                self.queue.task_done()
+
+    def send(self, notification_dispatch_id):
+        """Send the dispatch in its own transaction with a request made
+        from the registry."""
+
+        env = self.prepare(registry=self.registry)
+        try:
+            with transaction.manager:
+                request = env['request']
+                send_from_notification_dispatch(request, notification_dispatch_id)
+                request.notification_sender.flush()
+        finally:
+            env['closer']()
+            bm.Session.remove()
@@ -1,85 +1,438 @@
 # -*- coding: utf-8 -*-
 
+import logging
+logger = logging.getLogger(__name__)
+
+from multiprocessing.pool import ThreadPool
+from requests import adapters
 from sqlalchemy import create_engine
 from pyramid_basemodel import bind_engine, save, Session
-from pyramid_notification import DEFAULTS
+from pyramid_torque_engine import constants as c
 
+from . import DEFAULTS
+from . import channels
 from . import util
 from . import repo
 from . import orm
 
+import argparse
+import collections
 import os
 import datetime
+import itertools
 import json
 import requests
+import select
+import signal
+import socket
+import time
 import transaction
 
-AVAILABLE_CHANNELS = ['sms', 'email']
+# Users with these frequencies get a digest of their due dispatches.
+DIGEST_FREQUENCIES = ['daily', 'hourly']
 
 env = os.environ
 NOTIFICATION_SINGLE_ENDPOINT = env.get('NOTIFICATION_SINGLE_ENDPOINT', None)
+NOTIFICATION_BATCH_ENDPOINT = env.get('NOTIFICATION_BATCH_ENDPOINT', None)
+# How many due dispatches to stream from the db at a time.
+NOTIFICATION_YIELD_PER = int(env.get('NOTIFICATION_YIELD_PER', 1000))
+# How many due dispatches a worker claims at a time.
+NOTIFICATION_CLAIM_SIZE = int(env.get('NOTIFICATION_CLAIM_SIZE', 100))
+# How long, in seconds, a worker's claim lasts before others can take over.
+NOTIFICATION_LEASE = int(env.get('NOTIFICATION_LEASE', 300))
+# How long, in seconds, the daemon waits between polls when idle, backing
+# off from the min to the max.
+NOTIFICATION_POLL_MIN = float(env.get('NOTIFICATION_POLL_MIN', 1))
+NOTIFICATION_POLL_MAX = float(env.get('NOTIFICATION_POLL_MAX', 60))
+# How many dispatches to post to the endpoint concurrently. Can be set per
+# channel, e.g.: NOTIFICATION_SMS_CONCURRENCY, which otherwise defaults to
+# the pool size of the channel.
+NOTIFICATION_CONCURRENCY = int(env.get('NOTIFICATION_CONCURRENCY', 10))
+# Timeout in seconds for each post to the endpoint.
+NOTIFICATION_TIMEOUT = float(env.get('NOTIFICATION_TIMEOUT', 30))
+# How long, in seconds, to wait for a channel's rate limit before posting
+# anyway, leaving the endpoint to defer the dispatch. Rate limits can be set
+# per channel, e.g.: NOTIFICATION_SMS_RATE_LIMIT, and should match the
+# ``notification.channel.<name>.rate_limit`` settings of the app.
+NOTIFICATION_RATE_LIMIT_MAX_WAIT = float(env.get('NOTIFICATION_RATE_LIMIT_MAX_WAIT', 60))
+
+
+class NotificationDispatchPoster(object):
+    """Post notification dispatch ids to the notification endpoints using a
+    bounded pool of workers sharing a session of keep-alive connections.
+    A single id is posted to the single endpoint and a list of ids, for a
+    digest, to the batch endpoint.
+    """
+
+    def __init__(self, endpoint=None, concurrency=None, **kwargs):
+        self.endpoint = endpoint or NOTIFICATION_SINGLE_ENDPOINT
+        self.batch_endpoint = kwargs.get('batch_endpoint', NOTIFICATION_BATCH_ENDPOINT)
+        self.concurrency = concurrency or NOTIFICATION_CONCURRENCY
+        self.timeout = kwargs.get('timeout', NOTIFICATION_TIMEOUT)
+        self.throttle = kwargs.get('throttle', None)
+        self.pool = kwargs.get('pool_cls', ThreadPool)(self.concurrency)
+
+        # Build the headers once and keep a connection per worker alive.
+        api_key = kwargs.get('api_key', DEFAULTS['notification.api_key'])
+        header_names = kwargs.get('header_names', c.ENGINE_API_KEY_NAMES)
+        self.session = kwargs.get('session_cls', requests.Session)()
+        for item in header_names:
+            self.session.headers['{0}'.format(item)] = api_key
+        adapter = adapters.HTTPAdapter(pool_maxsize=self.concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def post(self, dispatch_id):
+        """Post a dispatch id, or a list of them, returning whether it
+        succeeded. Waits for the ``throttle``, if any, first."""
+
+        if self.throttle is not None:
+            self.throttle()
+        if isinstance(dispatch_id, list):
+            endpoint = self.batch_endpoint
+            data = json.dumps({'notification_dispatch_ids': dispatch_id})
+        else:
+            endpoint = self.endpoint
+            data = json.dumps({'notification_dispatch_id': dispatch_id})
+        try:
+            r = self.session.post(endpoint, data=data, timeout=self.timeout)
+            r.raise_for_status()
+        except requests.RequestException as err:
+            logger.warn('Notification: failed to post dispatch {0}: {1}'.format(
+                    dispatch_id, err))
+            return False
+        return True
 
+    def post_async(self, dispatch_ids):
+        """Start posting the dispatch ids concurrently, returning an async
+        result of whether each one succeeded."""
 
-def post_notification_dispatch(dispatch):
+        return self.pool.map_async(self.post, dispatch_ids)
 
-    headers = {}
-    for item in c.ENGINE_API_KEY_NAMES:
-        key = '{0}'.format(item)
-        headers[key] = DEFAULTS['notification.api_key']
+    def __call__(self, dispatch_ids):
+        """Post the dispatch ids concurrently, returning the ones that failed."""
+
+        results = self.post_async(dispatch_ids).get()
+        return [id_ for id_, ok in zip(dispatch_ids, results) if not ok]
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.session.close()
+
+
+class ChannelDispatchPoster(object):
+    """Post the ``(channel, dispatch_id)`` items through a poster per
+    channel, each with a pool of its own, so that the channels are posted
+    at the same time and a slow one doesn't hold up the others.
+    """
+
+    def __init__(self, **kwargs):
+        self.poster_cls = kwargs.get('poster_cls', NotificationDispatchPoster)
+        self.limiter_cls = kwargs.get('limiter_cls', channels.RateLimiter)
+        self.posters = {}
+
+    def get_concurrency(self, channel):
+        """Get the concurrency of the channel from the environment, falling
+        back on the pool size of the channel."""
+
+        name = 'NOTIFICATION_{0}_CONCURRENCY'.format(channel.upper())
+        if name in env:
+            return int(env[name])
+        channel_cls = channels.DEFAULT_CHANNELS.get(channel)
+        if channel_cls is None:
+            return NOTIFICATION_CONCURRENCY
+        return channel_cls.pool_size
+
+    def get_limiter(self, channel):
+        """Get a limiter that waits for the channel's rate limit, from the
+        environment or else the channel's, without taking the tokens, which
+        the endpoint takes as it sends. Returns None if there's no limit."""
+
+        name = 'NOTIFICATION_{0}_RATE_LIMIT'.format(channel.upper())
+        if name in env:
+            rate_limit = float(env[name])
+        else:
+            channel_cls = channels.DEFAULT_CHANNELS.get(channel, channels.Channel)
+            rate_limit = channel_cls.rate_limit
+        if not rate_limit:
+            return None
+        return self.limiter_cls(rate_limit, max_wait=NOTIFICATION_RATE_LIMIT_MAX_WAIT,
+                take=False)
+
+    def get_throttle(self, channel):
+        """Get what to call before each post of the channel, so that the
+        endpoint has to defer as few of them as possible."""
+
+        limiter = self.get_limiter(channel)
+        if limiter is None:
+            return None
+
+        def throttle():
+            try:
+                limiter(channel)
+            except channels.RateLimited as err:
+                logger.warn('Notification: posting over the rate limit: {0}'.format(err))
+        return throttle
+
+    def get_poster(self, channel):
+        poster = self.posters.get(channel)
+        if poster is None:
+            poster = self.poster_cls(concurrency=self.get_concurrency(channel),
+                    throttle=self.get_throttle(channel))
+            self.posters[channel] = poster
+        return poster
+
+    def __call__(self, items):
+        """Post the items of all the channels at once, returning the ones
+        that failed."""
+
+        by_channel = collections.defaultdict(list)
+        for channel, dispatch_id in items:
+            by_channel[channel].append(dispatch_id)
+
+        pending = []
+        for channel, dispatch_ids in by_channel.items():
+            result = self.get_poster(channel).post_async(dispatch_ids)
+            pending.append((channel, dispatch_ids, result))
+
+        failed = []
+        for channel, dispatch_ids, result in pending:
+            for id_, ok in zip(dispatch_ids, result.get()):
+                if not ok:
+                    failed.append((channel, id_))
+        return failed
+
+    def close(self):
+        for poster in self.posters.values():
+            poster.close()
 
-    _ = requests.post(
-                    NOTIFICATION_SINGLE_ENDPOINT,
-                    headers=headers,
-                    data=json.dumps(
-                        {'notification_dispatch_id': dispatch.id}))
 
 def dispatch_user_notifications(user, user_notifications):
     """ 4. for each channel loop and either write out a single or a batch dispatch task with the
         NotificationDispatcher ids e.g: /dispatch_email, /dispatch_sms and etc.
+        Returns what to post as ``(channel, item)`` pairs: the id of each
+        dispatch to send on its own and a list of ids for each digest, for
+        the channels that support batching.
     """
 
-    for ch in AVAILABLE_CHANNELS:
-        # XXX check for preferences e.g: and user.channel == ch
-        to_dispatch = [d for d in user_notifications if d.category == ch]
-        for dispatch in to_dispatch:
-            post_notification_dispatch(dispatch)
+    to_post = []
+    should_digest = NOTIFICATION_BATCH_ENDPOINT and user.frequency in DIGEST_FREQUENCIES
+    for ch in sorted(set(d.category for d in user_notifications)):
+        to_dispatch = [d.id for d in user_notifications if d.category == ch]
+        channel_cls = channels.DEFAULT_CHANNELS.get(ch, channels.Channel)
+        if should_digest and channel_cls.supports_batching and len(to_dispatch) > 1:
+            to_post.append((ch, to_dispatch))
         else:
-            print 'nothing here', to_dispatch
-    Session.flush()
+            to_post.extend((ch, id_) for id_ in to_dispatch)
+    return to_post
 
 
-def run():
-    # Bind to the database.
-    engine = create_engine(os.environ['DATABASE_URL'])
-    bind_engine(engine, should_create=False)
+def dispatch_by_user(by_user, preferences):
+    """Yield what to post for the dispatches grouped by user id, creating
+    the missing notification preferences on the fly."""
 
-    # Prepare.
-    notification_cls = orm.Notification
-    notification_dispatch_cls = orm.NotificationDispatch
     notification_preference_factory = repo.NotificationPreferencesFactory()
+    for user_id, user_notifications in by_user:
+        user = preferences.get(user_id)
+        # If we don't have a notification preference object, we just create it on the fly.
+        if user is None:
+            user = notification_preference_factory(user_id)
+        for item in dispatch_user_notifications(user, list(user_notifications)):
+            yield item
+
+
+def record_failures(failed):
+    """Record a failed attempt for each of the dispatches of the failed
+    posts, so they back off before they're retried."""
+
+    failures = []
+    for channel, item in failed:
+        dispatch_ids = item if isinstance(item, list) else [item]
+        error = u'Failed to post to the {0} notification endpoint.'.format(channel)
+        failures.extend((id_, error) for id_ in dispatch_ids)
+    with transaction.manager:
+        repo.mark_dispatches_failed(failures)
+
+
+def scan(poster):
+    """Scan all of the due dispatches and post them, returning how many
+    posts were made."""
+
+    # Prepare.
+    lookup = repo.LookupNotificationDispatch()
+    preference_lookup = repo.LookupNotificationPreference()
     now = datetime.datetime.now()
+    to_post = []
+    failed = []
+    count = 0
 
     # Run the algorithm.
     with transaction.manager:
-        # 1. ignore all the notifications from the Notification table that have read field set.
-        unread_notifications = notification_dispatch_cls.query.join(notification_cls).filter(notification_cls.read == None)
-
-        # 2. get all of the non duplicated user ids who are due to dispatch and have not been sent.
-        due_to_dispatch = unread_notifications.filter(notification_dispatch_cls.due <= now).filter(notification_dispatch_cls.sent == None)
-        user_ids_to_dispatch = set()
-        for dispatch in due_to_dispatch.all():
-            user_ids_to_dispatch.add(dispatch.notification.user_id)
-
-        # 3. for each user id get all of the notifications grouped by channel
-        for user_id in user_ids_to_dispatch:
-            # Build the NotificationPreference object so we can get the preferences.
-            user = orm.NotificationPreference.query.filter_by(user_id=user_id).all()[-1]
-            # If we don't have a notification preference object, we just create it on the fly.
-            if user is None:
-                user = notification_preference_factory(user_id)
-            user_notifications = due_to_dispatch.filter(notification_cls.user_id == user_id).all()
-            dispatch_user_notifications(user, user_notifications)
+        # 1. get the preferences of all the users who have unread notifications
+        # due to dispatch and not sent, in one query.
+        due_user_ids = lookup.due_user_ids(now).subquery()
+        preferences = preference_lookup.by_user_ids(due_user_ids)
+
+        # 2. stream the due dispatches with their notification, ordered by
+        # user id and channel so we can group them without further queries.
+        due_to_dispatch = lookup.due_by_user(now).yield_per(NOTIFICATION_YIELD_PER)
+        by_user = itertools.groupby(due_to_dispatch, lambda d: d.notification.user_id)
+
+        # 3. for each user dispatch all of the notifications grouped by channel.
+        for item in dispatch_by_user(by_user, preferences):
+            to_post.append(item)
+
+            # 4. post them through the worker pool a chunk at a time.
+            if len(to_post) >= NOTIFICATION_YIELD_PER:
+                count += len(to_post)
+                failed.extend(poster(to_post))
+                to_post = []
+        count += len(to_post)
+        failed.extend(poster(to_post))
+
+    # 5. retry the failures once, they back off and are picked up by a later
+    # run otherwise.
+    if failed:
+        failed = poster(failed)
+    if failed:
+        logger.warn('Notification: failed to post dispatches {0}'.format(failed))
+        record_failures(failed)
+
+    return count
+
+
+def work(poster, worker_id):
+    """Claim batches of due dispatches and post them until there are none
+    left, returning how many posts were made. Many workers can run at once
+    without posting the same dispatch.
+    """
+
+    claim = repo.ClaimNotificationDispatches(worker_id, lease=NOTIFICATION_LEASE)
+    lookup = repo.LookupNotificationDispatch()
+    preference_lookup = repo.LookupNotificationPreference()
+    count = 0
+    while True:
+        # Commit the claim straight away so the other workers skip it.
+        with transaction.manager:
+            dispatch_ids = claim(NOTIFICATION_CLAIM_SIZE)
+        if not dispatch_ids:
+            return count
+
+        # Group the claimed dispatches by user into digests.
+        with transaction.manager:
+            dispatches = lookup.by_ids(dispatch_ids)
+            user_ids = set(d.notification.user_id for d in dispatches)
+            preferences = preference_lookup.get_many(user_ids)
+            by_user = itertools.groupby(dispatches, lambda d: d.notification.user_id)
+            to_post = list(dispatch_by_user(by_user, preferences))
+        count += len(to_post)
+
+        # The failures are released to back off before they're retried.
+        failed = poster(to_post)
+        if failed:
+            logger.warn('Notification: failed to post dispatches {0}'.format(failed))
+            record_failures(failed)
 
 
+def listen(engine):
+    """Listen for the due dispatches on a connection of our own."""
+
+    listener = engine.raw_connection()
+    connection = listener.connection
+    connection.set_isolation_level(0)
+    connection.cursor().execute('LISTEN {0}'.format(repo.NOTIFY_CHANNEL))
+    return listener
+
+
+def serve(engine, dispatch, stopping=None):
+    """Keep dispatching until sent SIGTERM, or until something is appended
+    to the ``stopping`` list. Waits for a notification that new dispatches
+    are due, backing off when there's nothing to do or it fails. Listens
+    again if the connection is lost, polling in the meantime."""
+
+    if stopping is None:
+        stopping = []
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+
+    listener = None
+    interval = NOTIFICATION_POLL_MIN
+    try:
+        while not stopping:
+            if listener is None:
+                try:
+                    listener = listen(engine)
+                except Exception:
+                    logger.exception('Notification: failed to listen for due dispatches')
+
+            try:
+                if dispatch():
+                    interval = NOTIFICATION_POLL_MIN
+                else:
+                    interval = min(interval * 2, NOTIFICATION_POLL_MAX)
+            except Exception:
+                logger.exception('Notification: failed to dispatch')
+                interval = min(interval * 2, NOTIFICATION_POLL_MAX)
+
+            # Wait for a notification or the poll interval.
+            if listener is None:
+                time.sleep(interval)
+                continue
+            connection = listener.connection
+            try:
+                readable, _, _ = select.select([connection], [], [], interval)
+                if readable:
+                    connection.poll()
+                    del connection.notifies[:]
+                    interval = NOTIFICATION_POLL_MIN
+            except select.error:
+                continue
+            except Exception:
+                logger.exception('Notification: lost the connection listening for due dispatches')
+                try:
+                    listener.close()
+                except Exception:
+                    pass
+                listener = None
+    finally:
+        if listener is not None:
+            listener.close()
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description='Dispatch the due notifications.')
+    parser.add_argument('--worker', action='store_true',
+            help='Claim batches of dispatches so that many processes can run at once.')
+    parser.add_argument('--worker-id',
+            default='{0}:{1}'.format(socket.gethostname(), os.getpid()),
+            help='Identifies the worker in its claims.')
+    parser.add_argument('--daemon', action='store_true',
+            help='Keep running, waking up as soon as new dispatches are due.')
+    parser.add_argument('--reconcile', action='store_true',
+            help='Recount the unread notifications of every user and exit.')
+    args = parser.parse_args(argv)
+
+    # Bind to the database.
+    engine = create_engine(os.environ['DATABASE_URL'])
+    bind_engine(engine, should_create=False)
+
+    if args.reconcile:
+        with transaction.manager:
+            repo.reconcile_unread_counts()
+        return
+
+    poster = ChannelDispatchPoster()
+    if args.worker:
+        dispatch = lambda: work(poster, args.worker_id)
+    else:
+        dispatch = lambda: scan(poster)
+    try:
+        if args.daemon:
+            serve(engine, dispatch)
+        else:
+            dispatch()
+    finally:
+        poster.close()
+
 if __name__ == '__main__':
     run()
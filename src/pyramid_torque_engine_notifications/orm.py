@@ -7,6 +7,8 @@ __all__ = [
     'Notification',
     'NotificationDispatch',
     'NotificationPreference',
+    'NotificationUnreadCount',
+    'NotificationRateLimit',
 ]
 
 import os
@@ -42,10 +44,23 @@ class NotificationDispatch(bm.Base, bm.BaseMixin):
     # Has a sent date.
     sent = schema.Column(types.DateTime)
 
+    # Has a lease, when and by which worker it was claimed.
+    claimed_at = schema.Column(types.DateTime)
+    claimed_by = schema.Column(types.Unicode(96))
+
+    # Has the number of failed attempts, the last error and when to try
+    # again. Set as dead, and no longer retried, after too many attempts.
+    attempts = schema.Column(types.Integer, default=0, server_default='0',
+            nullable=False)
+    last_error = schema.Column(types.UnicodeText)
+    next_attempt = schema.Column(types.DateTime)
+    dead = schema.Column(types.DateTime)
+
     # has a Notification.
     notification_id = schema.Column(
         types.Integer,
         schema.ForeignKey('notifications.id'),
+        index=True,
     )
 
     # bcc info
@@ -62,6 +77,13 @@ class NotificationDispatch(bm.Base, bm.BaseMixin):
     # email or telephone number
     address = schema.Column(types.Unicode(96))
 
+# The executer scans the due dispatches that haven't been sent yet and
+# aren't dead, which is a small and hot fraction of the table.
+schema.Index('ix_notifications_dispatch_due_unsent',
+        NotificationDispatch.due, NotificationDispatch.notification_id,
+        postgresql_where=sql.and_(NotificationDispatch.sent == None,
+                NotificationDispatch.dead == None))
+
 class Notification(bm.Base, bm.BaseMixin):
     """A notification about an event that should be sent to an user."""
 
@@ -71,6 +93,7 @@ class Notification(bm.Base, bm.BaseMixin):
     user_id = schema.Column(
         types.Integer,
         schema.ForeignKey('auth_users.id'),
+        index=True,
     )
 
     user = orm.relationship(
@@ -90,6 +113,7 @@ class Notification(bm.Base, bm.BaseMixin):
     event_id = schema.Column(
         types.Integer,
         schema.ForeignKey('activity_events.id'),
+        index=True,
     )
     event = orm.relationship(
         ActivityEvent,
@@ -105,18 +129,26 @@ class Notification(bm.Base, bm.BaseMixin):
             'id': self.id,
             'user_id': self.user_id,
             'created_at': self.created.isoformat(),
-            'read_at': self.read.isoformat(),
+            'read_at': self.read.isoformat() if self.read else None,
             'event_id': self.event_id,
         }
         return data
 
+# The inbox pages through a user's notifications by (created, id) and
+# counts the unread ones.
+schema.Index('ix_notifications_user_id_created_id',
+        Notification.user_id, Notification.created, Notification.id)
+schema.Index('ix_notifications_user_id_unread', Notification.user_id,
+        postgresql_where=Notification.read == None)
+
 class NotificationPreference(bm.Base, bm.BaseMixin):
     """Encapsulate user's notification preferences."""
 
     __tablename__ = 'notification_preferences'
 
-    # Belongs to a user.
-    user_id = schema.Column(types.Integer, schema.ForeignKey('auth_users.id'))
+    # Belongs to a user, with one set of preferences per user.
+    user_id = schema.Column(types.Integer, schema.ForeignKey('auth_users.id'),
+            unique=True)
     user = orm.relationship(simpleauth_model.User, single_parent=True,
             backref=orm.backref('notification_preference', single_parent=True, uselist=False))
 
@@ -125,11 +157,40 @@ class NotificationPreference(bm.Base, bm.BaseMixin):
     channel = schema.Column(types.Unicode(96))
     # simple for the moment, either daily or weekly. XXX use ENUM.
     frequency = schema.Column(types.Unicode(96))
+    # tz database name, e.g.: Europe/London, defaults to the server's.
+    timezone = schema.Column(types.Unicode(64))
 
     def __json__(self, request=None):
         return {
             'id': self.id,
             'frequency': self.frequency,
             'channel': self.channel,
+            'timezone': self.timezone,
             'user_id': self.user_id,
         }
+
+class NotificationUnreadCount(bm.Base):
+    """A denormalised count of a user's unread notifications, kept up to
+    date as they're created and read."""
+
+    __tablename__ = 'notification_unread_counts'
+
+    # Belongs to a user.
+    user_id = schema.Column(types.Integer, schema.ForeignKey('auth_users.id'),
+            primary_key=True)
+
+    unread = schema.Column(types.Integer, nullable=False, default=0,
+            server_default='0')
+
+
+class NotificationRateLimit(bm.Base):
+    """A token bucket shared by all the processes sending through a channel,
+    or a channel and recipient domain, e.g.: ``email:gmail.com``."""
+
+    __tablename__ = 'notification_rate_limits'
+
+    key = schema.Column(types.Unicode(255), primary_key=True)
+
+    # The tokens left and when it was last refilled.
+    tokens = schema.Column(types.Float, nullable=False)
+    updated = schema.Column(types.DateTime, nullable=False)
@@ -4,23 +4,68 @@
 
 __all__ = [
     'NotificationFactory',
+    'BulkNotificationFactory',
+    'ClaimNotificationDispatches',
     'LookupNotification',
     'LookupNotificationDispatch',
+    'LookupNotificationPreference',
     'NotificationPreferencesFactory',
+    'insert_notification_preferences',
     'get_or_create_notification_preferences',
+    'update_notification_preferences',
+    'mark_dispatches_sent',
+    'mark_dispatches_failed',
+    'defer_dispatches',
+    'mark_notifications_read',
+    'mark_user_notifications_read',
+    'get_unread_count',
+    'reconcile_unread_counts',
+    'take_tokens',
 ]
 
 import logging
 logger = logging.getLogger(__name__)
 
+import collections
 import json
 import pyramid_basemodel as bm
 
+from sqlalchemy import sql
+from sqlalchemy import types
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import contains_eager
+from sqlalchemy.orm import joinedload
+
 from . import orm
+from . import schedule
 from . import util
 
 import datetime
-from dateutil.relativedelta import relativedelta
+from repoze.lru import ExpiringLRUCache
+
+# Postgres channel notified when dispatches that are due now are created.
+NOTIFY_CHANNEL = 'notifications_dispatch'
+
+# Failed dispatches are retried after BACKOFF_BASE * 2 ** attempts seconds,
+# up to BACKOFF_MAX, and given up on after MAX_ATTEMPTS.
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = 60
+BACKOFF_MAX = 6 * 60 * 60
+
+# How long, in seconds, a claimed dispatch is left to its worker before it's
+# considered abandoned and can be claimed again.
+CLAIM_LEASE = 300
+
+# A user's notification preferences, as cached for the life of the process.
+Preference = collections.namedtuple('Preference', ['user_id', 'frequency', 'channel',
+        'timezone'])
+
+# How many users' preferences to cache and for how long, in seconds. Other
+# processes' updates are seen once the entries expire.
+PREFERENCE_CACHE_SIZE = 10000
+PREFERENCE_CACHE_TTL = 60
+preference_cache = ExpiringLRUCache(PREFERENCE_CACHE_SIZE,
+        default_timeout=PREFERENCE_CACHE_TTL)
 
 
 class NotificationFactory(object):
@@ -33,6 +78,7 @@ class NotificationFactory(object):
                 orm.NotificationDispatch)
         self.notification_preference_factory = kwargs.get('notification_preference_factory',
                 NotificationPreferencesFactory())
+        self.scheduler = kwargs.get('scheduler', schedule.Scheduler())
         self.session = kwargs.get('session', bm.Session)
 
     def __call__(self, event, user, dispatch_mapping, delay=None, bcc=None):
@@ -45,28 +91,13 @@ class NotificationFactory(object):
         # Create notification.
         notification = self.notification_cls(user=user, event=event)
         session.add(notification)
-        due = datetime.datetime.now()
         email = user.best_email.address
 
         # Get or create user preferences.
         preference = get_or_create_notification_preferences(user)
-        timeframe = preference.frequency
+        due = self.scheduler.due(preference.frequency, delay, preference.timezone,
+                user_id=user.id)
 
-        # If daily normalise to 20h of each day.
-        if timeframe == 'daily':
-            if due.hour > 20:
-                due = datetime.datetime(due.year, due.month, due.day + 1, 20)
-            else:
-                due = datetime.datetime(due.year, due.month, due.day, 20)
-
-        # If hourly normalise to the next hour.
-        elif timeframe == 'hourly':
-            due = datetime.datetime(due.year, due.month, due.day, due.hour + 1, 0)
-
-        # Check if there's a delay in minutes add to it.
-        if delay:
-            delay = relativedelta(minutes=delay)
-            due = due + delay
         if bcc:
             if bcc is True or bcc == '':
                 bcc = util.extract_us(request)
@@ -81,13 +112,236 @@ class NotificationFactory(object):
         # Save to the database.
         session.flush()
 
+        # Count it as unread.
+        increment_unread_counts([user.id], session=session)
+
+        # Wake up the executer on commit if they're due now.
+        if dispatch_mapping and due <= datetime.datetime.now():
+            notify_due(session)
+
         return notification
 
+class BulkNotificationFactory(object):
+    """Boilerplate to create and save ``Notification``s for many users at
+    once, using bulk inserts instead of a flush per user.
+    """
+
+    def __init__(self, request, **kwargs):
+        self.request = request
+        self.notification_cls = kwargs.get('notification_cls', orm.Notification)
+        self.notification_dispatch_cls = kwargs.get('notification_dispatch_cls',
+                orm.NotificationDispatch)
+        self.notification_preference_cls = kwargs.get('notification_preference_cls',
+                orm.NotificationPreference)
+        self.event_cls = kwargs.get('event_cls', orm.ActivityEvent)
+        self.preference_lookup = kwargs.get('preference_lookup',
+                LookupNotificationPreference())
+        self.scheduler = kwargs.get('scheduler', schedule.Scheduler())
+        self.lease = kwargs.get('lease', CLAIM_LEASE)
+        self.session = kwargs.get('session', bm.Session)
+
+    def next_ids(self, count):
+        """Reserve ``count`` notification ids from the table's sequence in
+        one query, so the dispatches can reference them without a flush."""
+
+        sequence = '{0}_id_seq'.format(self.notification_cls.__tablename__)
+        query = sql.text('SELECT nextval(:sequence) FROM generate_series(1, :count)')
+        result = self.session.execute(query, {'sequence': sequence, 'count': count})
+        return [row[0] for row in result]
+
+    def get_pending(self, event, user_ids, window):
+        """Get the latest unread notification of each user about the event's
+        parent, from the last ``window`` minutes, that has dispatches yet to
+        be delivered. Returns them by user id along with the ids of their
+        undelivered dispatches by ``(notification_id, channel)``, which are
+        locked until the end of the transaction. Dispatches claimed by a
+        worker may be being sent, so they're left be.
+        """
+
+        # Unpack.
+        notification_cls = self.notification_cls
+        dispatch_cls = self.notification_dispatch_cls
+        event_cls = self.event_cls
+
+        # The created dates are naive UTC times.
+        since = datetime.datetime.utcnow() - datetime.timedelta(minutes=window)
+        expired = datetime.datetime.now() - datetime.timedelta(seconds=self.lease)
+        query = self.session.query(notification_cls.user_id, notification_cls.id,
+                dispatch_cls.category, dispatch_cls.id)
+        query = query.join(dispatch_cls, dispatch_cls.notification_id == notification_cls.id)
+        query = query.join(event_cls, event_cls.id == notification_cls.event_id)
+        query = query.filter(any_of(notification_cls.user_id, user_ids),
+                notification_cls.read == None, notification_cls.created >= since,
+                dispatch_cls.sent == None, dispatch_cls.dead == None,
+                sql.or_(dispatch_cls.claimed_at == None,
+                        dispatch_cls.claimed_at < expired),
+                event_cls.parent_type == event.parent_type,
+                event_cls.parent_id == event.parent_id)
+        query = query.order_by(notification_cls.id).with_for_update(of=dispatch_cls)
+
+        notifications = {}
+        pending = {}
+        for user_id, notification_id, channel, dispatch_id in query:
+            notifications[user_id] = notification_id
+            pending[(notification_id, channel)] = dispatch_id
+        return notifications, pending
+
+    def coalesce(self, event, notification_ids, dispatch_ids, dispatch_mapping, bcc):
+        """Update the notifications to be about the event and their pending
+        dispatches to send it, with an update per channel. Their failed
+        attempts were at sending the old event, so they start over."""
+
+        # Unpack.
+        notification_cls = self.notification_cls
+        dispatch_cls = self.notification_dispatch_cls
+
+        query = notification_cls.query.filter(any_of(notification_cls.id, notification_ids))
+        query.update({'event_id': event.id}, synchronize_session=False)
+        for k, v in dispatch_mapping.items():
+            ids = [dispatch_ids[(id_, k)] for id_ in notification_ids
+                    if (id_, k) in dispatch_ids]
+            if not ids:
+                continue
+            query = dispatch_cls.query.filter(any_of(dispatch_cls.id, ids))
+            query.update({'view': v['view'], 'single_spec': v['single'],
+                    'batch_spec': v['batch'], 'bcc': bcc, 'attempts': 0,
+                    'last_error': None, 'next_attempt': None},
+                    synchronize_session=False)
+
+    def __call__(self, event, users, dispatch_mapping, delay=None, bcc=None,
+            coalesce=None):
+        """Create and store a notification and its notification dispatches
+        for each of the users, returning the notification ids.
+
+        Each user is notified once, however many times they're given. If
+        ``coalesce`` is a number of minutes, the users who have a pending
+        notification about the event's parent from within that window have
+        it updated in place instead.
+        """
+
+        # Unpack.
+        session = self.session
+        request = self.request
+
+        # Make sure the event and users have been written.
+        users = list(users)
+        if not users:
+            return []
+        session.flush()
+        users = collections.OrderedDict((user.id, user) for user in users).values()
+
+        # Get the user preferences in one query, and create the missing ones.
+        user_ids = [user.id for user in users]
+        preferences = self.preference_lookup.get_many(user_ids)
+        missing = set(user_ids).difference(preferences)
+        if missing:
+            inserted = insert_notification_preferences(missing,
+                    model_cls=self.notification_preference_cls, session=session)
+
+            # Pick up the ones a concurrent transaction created in the meantime.
+            existing = missing.difference(inserted)
+            if existing:
+                preferences.update(self.preference_lookup.get_many(existing))
+
+        if bcc:
+            if bcc is True or bcc == '':
+                bcc = util.extract_us(request)
+
+        # Work out when they're due for all of the users at once.
+        recipients = []
+        for user_id in set(user_ids):
+            preference = preferences.get(user_id)
+            if preference:
+                recipients.append((user_id, preference.frequency, preference.timezone))
+            else:
+                recipients.append((user_id, None, None))
+        due_dates = self.scheduler.schedule(recipients, delay)
+
+        def make_dispatch(notification_id, user, k, v):
+            return dict(notification_id=notification_id, due=due_dates[user.id],
+                    category=k, view=v['view'], bcc=bcc, single_spec=v['single'],
+                    batch_spec=v['batch'], address=user.best_email.address)
+
+        # Coalesce into the users' pending notifications, adding the
+        # dispatches of the channels they don't have pending.
+        coalesced = {}
+        notification_dispatches = []
+        if coalesce:
+            coalesced, pending = self.get_pending(event, user_ids, coalesce)
+        if coalesced:
+            self.coalesce(event, coalesced.values(), pending, dispatch_mapping, bcc)
+            for user in users:
+                notification_id = coalesced.get(user.id)
+                if notification_id is None:
+                    continue
+                for k, v in dispatch_mapping.items():
+                    if (notification_id, k) not in pending:
+                        notification_dispatches.append(make_dispatch(notification_id,
+                                user, k, v))
+            users = [user for user in users if user.id not in coalesced]
+
+        # Build the notifications and a notification dispatch for each channel.
+        notification_ids = self.next_ids(len(users)) if users else []
+        notifications = []
+        for notification_id, user in zip(notification_ids, users):
+            notifications.append(dict(id=notification_id, user_id=user.id,
+                    event_id=event.id))
+            for k, v in dispatch_mapping.items():
+                notification_dispatches.append(make_dispatch(notification_id,
+                        user, k, v))
+
+        # Save to the database.
+        session.bulk_insert_mappings(self.notification_cls, notifications)
+        session.bulk_insert_mappings(self.notification_dispatch_cls,
+                notification_dispatches)
+
+        # Count the new ones as unread, the coalesced ones already are.
+        increment_unread_counts([user.id for user in users], session=session)
+
+        # Wake up the executer on commit if any are due now.
+        now = datetime.datetime.now()
+        if notification_dispatches and min(due_dates.values()) <= now:
+            notify_due(session)
+
+        return notification_ids + coalesced.values()
+
+class LookupNotification(object):
+    """Lookup notifications."""
+
+    def __init__(self, **kwargs):
+        self.model_cls = kwargs.get('model_cls', orm.Notification)
+
+    def __call__(self, id_):
+        """Lookup by notification id."""
+
+        return self.model_cls.query.get(id_)
+
+    def inbox(self, user_id, limit, before=None, unread_only=False):
+        """Lookup a page of the user's notifications, newest first, with
+        their event eager loaded. ``before`` is the ``(created, id)`` of the
+        last notification of the previous page.
+        """
+
+        model_cls = self.model_cls
+
+        query = model_cls.query.filter(model_cls.user_id == user_id)
+        if unread_only:
+            query = query.filter(model_cls.read == None)
+        if before is not None:
+            created, id_ = before
+            query = query.filter(sql.tuple_(model_cls.created, model_cls.id) <
+                    sql.tuple_(created, id_))
+        query = query.options(joinedload(model_cls.event))
+        query = query.order_by(model_cls.created.desc(), model_cls.id.desc())
+        return query.limit(limit).all()
+
 class LookupNotificationDispatch(object):
     """Lookup notifications dispatch."""
 
     def __init__(self, **kwargs):
         self.model_cls = kwargs.get('model_cls', orm.NotificationDispatch)
+        self.notification_cls = kwargs.get('notification_cls', orm.Notification)
+        self.lease = kwargs.get('lease', CLAIM_LEASE)
 
     def __call__(self, id_):
         """Lookup by notifiction dispatch id."""
@@ -100,6 +354,480 @@ class LookupNotificationDispatch(object):
 
         return self.model_cls.query.filter_by(notification_id=id_).all()
 
+    def by_ids(self, ids):
+        """Lookup all the unsent and live notification dispatches with the
+        given ids, with their notification and event eager loaded, in one
+        query."""
+
+        # Unpack.
+        model_cls = self.model_cls
+        notification_cls = self.notification_cls
+
+        query = model_cls.query.join(notification_cls).filter(
+                model_cls.id.in_(ids), model_cls.sent == None,
+                model_cls.dead == None)
+        query = query.options(contains_eager(model_cls.notification)
+                .joinedload(notification_cls.event))
+        return query.order_by(notification_cls.user_id, model_cls.id).all()
+
+    def due_by_user_id(self, user_id, channel, now):
+        """Lookup all the due notification dispatches for the user and channel,
+        with their notification and event eager loaded, in one query."""
+
+        # Unpack.
+        model_cls = self.model_cls
+        notification_cls = self.notification_cls
+
+        query = self.due(now).filter(notification_cls.user_id == user_id,
+                model_cls.category == channel)
+        query = query.options(contains_eager(model_cls.notification)
+                .joinedload(notification_cls.event))
+        return query.order_by(model_cls.id).all()
+
+    def due_by_notification_ids(self, ids, now):
+        """Lookup all the due notification dispatches of the notifications,
+        with their notification and event eager loaded, in one query."""
+
+        # Unpack.
+        model_cls = self.model_cls
+        notification_cls = self.notification_cls
+
+        query = self.due(now).filter(model_cls.notification_id.in_(ids))
+        query = query.options(contains_eager(model_cls.notification)
+                .joinedload(notification_cls.event))
+        return query.order_by(model_cls.id).all()
+
+    def due(self, now):
+        """Query the dispatches that are due and haven't been sent, ignoring
+        the ones whose notification has already been read, the dead ones, the
+        failed ones that are backing off and the ones claimed by a worker."""
+
+        # Unpack.
+        model_cls = self.model_cls
+        notification_cls = self.notification_cls
+
+        expired = now - datetime.timedelta(seconds=self.lease)
+        query = model_cls.query.join(notification_cls)
+        return query.filter(notification_cls.read == None,
+                model_cls.due <= now, model_cls.sent == None,
+                model_cls.dead == None, sql.or_(model_cls.next_attempt == None,
+                        model_cls.next_attempt <= now),
+                sql.or_(model_cls.claimed_at == None, model_cls.claimed_at < expired))
+
+    def due_by_user(self, now):
+        """Query the due dispatches with their notification eager loaded,
+        ordered so they can be streamed and grouped by user and channel."""
+
+        # Unpack.
+        model_cls = self.model_cls
+        notification_cls = self.notification_cls
+
+        query = self.due(now).options(contains_eager(model_cls.notification))
+        return query.order_by(notification_cls.user_id, model_cls.category,
+                model_cls.id)
+
+    def due_user_ids(self, now):
+        """Query the distinct ids of the users that have due dispatches."""
+
+        user_id = self.notification_cls.user_id
+        return self.due(now).with_entities(user_id).distinct()
+
+class ClaimNotificationDispatches(object):
+    """Lease due notification dispatches to a worker. Rows locked by other
+    workers are skipped, so many workers can drain the queue side by side,
+    and rows whose lease has expired are claimed again.
+    Requires PostgreSQL 9.5 or later.
+    """
+
+    def __init__(self, worker_id, **kwargs):
+        self.worker_id = worker_id
+        self.lease = kwargs.get('lease', CLAIM_LEASE)
+        self.model_cls = kwargs.get('model_cls', orm.NotificationDispatch)
+        self.notification_cls = kwargs.get('notification_cls', orm.Notification)
+        self.session = kwargs.get('session', bm.Session)
+
+    def __call__(self, limit, now=None):
+        """Claim up to ``limit`` due dispatches, returning their ids."""
+
+        now = now or datetime.datetime.now()
+        expired = now - datetime.timedelta(seconds=self.lease)
+        query = sql.text("""
+            UPDATE {dispatches} SET claimed_at = :now, claimed_by = :worker_id
+             WHERE id IN (
+                SELECT d.id FROM {dispatches} d
+                  JOIN {notifications} n ON n.id = d.notification_id
+                 WHERE n.read IS NULL AND d.due <= :now AND d.sent IS NULL
+                   AND d.dead IS NULL
+                   AND (d.next_attempt IS NULL OR d.next_attempt <= :now)
+                   AND (d.claimed_at IS NULL OR d.claimed_at < :expired)
+                 ORDER BY d.due
+                 LIMIT :limit
+                   FOR UPDATE OF d SKIP LOCKED)
+            RETURNING id
+        """.format(dispatches=self.model_cls.__tablename__,
+                notifications=self.notification_cls.__tablename__))
+        result = self.session.execute(query, {'now': now, 'expired': expired,
+                'worker_id': self.worker_id, 'limit': limit})
+        return [row[0] for row in result]
+
+    def by_ids(self, ids, now=None):
+        """Claim the dispatches with the given ids that are unsent and not
+        claimed by another worker, returning their ids."""
+
+        if not ids:
+            return []
+
+        now = now or datetime.datetime.now()
+        expired = now - datetime.timedelta(seconds=self.lease)
+        query = sql.text("""
+            UPDATE {dispatches} SET claimed_at = :now, claimed_by = :worker_id
+             WHERE id = ANY(:ids) AND sent IS NULL AND dead IS NULL
+               AND (claimed_at IS NULL OR claimed_at < :expired)
+            RETURNING id
+        """.format(dispatches=self.model_cls.__tablename__))
+        query = query.bindparams(sql.bindparam('ids',
+                type_=postgresql.ARRAY(types.Integer)))
+        result = self.session.execute(query, {'now': now, 'expired': expired,
+                'worker_id': self.worker_id, 'ids': list(ids)})
+        return sorted(row[0] for row in result)
+
+class LookupNotificationPreference(object):
+    """Lookup notification preferences."""
+
+    def __init__(self, **kwargs):
+        self.model_cls = kwargs.get('model_cls', orm.NotificationPreference)
+        self.cache = kwargs.get('cache', preference_cache)
+
+    def get_many(self, user_ids):
+        """Map each of the user ids that has notification preferences to its
+        ``Preference``, from the cache or else using a single query."""
+
+        cache = self.cache
+
+        preferences = {}
+        missing = []
+        for user_id in set(user_ids):
+            preference = cache.get(user_id)
+            if preference is None:
+                missing.append(user_id)
+            else:
+                preferences[user_id] = preference
+
+        # Load and cache the rest.
+        if missing:
+            for user_id, p in self.by_user_ids(missing).items():
+                preference = Preference(p.user_id, p.frequency, p.channel, p.timezone)
+                cache.put(user_id, preference)
+                preferences[user_id] = preference
+
+        return preferences
+
+    def by_user_ids(self, user_ids):
+        """Map each of the user ids, either a list or a subquery, to its
+        latest notification preference using a single query."""
+
+        model_cls = self.model_cls
+        query = model_cls.query.filter(model_cls.user_id.in_(user_ids))
+        return dict((p.user_id, p) for p in query.order_by(model_cls.id))
+
+def any_of(column, ids):
+    """Match the column against the ids as a single array parameter, i.e.:
+    ``column = ANY(:ids)``, rather than a parameter per id."""
+
+    ids = sql.bindparam('ids', list(ids), type_=postgresql.ARRAY(types.Integer))
+    return column == sql.func.any(ids)
+
+def mark_dispatches_sent(notification_dispatch_ids, now=None, **kwargs):
+    """Set the sent date of many notification dispatches with one update,
+    returning how many were updated."""
+
+    model_cls = kwargs.get('model_cls', orm.NotificationDispatch)
+    if not notification_dispatch_ids:
+        return 0
+
+    now = now or datetime.datetime.now()
+    query = model_cls.query.filter(any_of(model_cls.id, notification_dispatch_ids))
+    return query.update({'sent': now}, synchronize_session=False)
+
+
+def mark_dispatches_failed(failures, now=None, **kwargs):
+    """Record a failed attempt for each of the ``(notification_dispatch_id,
+    error)`` failures, releasing its claim and backing off exponentially
+    before the next attempt. Dispatches that have failed ``max_attempts``
+    times are set as dead."""
+
+    model_cls = kwargs.get('model_cls', orm.NotificationDispatch)
+    session = kwargs.get('session', bm.Session)
+    max_attempts = kwargs.get('max_attempts', MAX_ATTEMPTS)
+    backoff_base = kwargs.get('backoff_base', BACKOFF_BASE)
+    backoff_max = kwargs.get('backoff_max', BACKOFF_MAX)
+
+    if not failures:
+        return
+    now = now or datetime.datetime.now()
+
+    # One error per dispatch, in id order.
+    errors = dict((id_, u'{0}'.format(error)[:1024]) for id_, error in failures)
+    ids = sorted(errors)
+    query = sql.text("""
+        UPDATE {table} d
+           SET attempts = d.attempts + 1,
+               last_error = f.error,
+               next_attempt = :now + LEAST(:backoff_base * POWER(2, d.attempts),
+                       :backoff_max) * INTERVAL '1 second',
+               dead = CASE WHEN d.attempts + 1 >= :max_attempts THEN :now END,
+               claimed_at = NULL,
+               claimed_by = NULL
+          FROM unnest(:ids, :errors) AS f(id, error)
+         WHERE d.id = f.id AND d.sent IS NULL
+     RETURNING d.id, d.dead
+    """.format(table=model_cls.__tablename__))
+    query = query.bindparams(
+            sql.bindparam('ids', ids, type_=postgresql.ARRAY(types.Integer)),
+            sql.bindparam('errors', [errors[id_] for id_ in ids],
+                    type_=postgresql.ARRAY(types.UnicodeText)))
+    params = {'now': now, 'max_attempts': max_attempts,
+            'backoff_base': backoff_base, 'backoff_max': backoff_max}
+    for row in session.execute(query, params):
+        if row.dead is not None:
+            logger.warn('Notification: dispatch {0} is dead after {1} attempts'.format(
+                    row.id, max_attempts))
+
+
+def defer_dispatches(notification_dispatch_ids, seconds, now=None, **kwargs):
+    """Put off the next attempt of the dispatches by ``seconds``, releasing
+    their claim without counting it as a failed attempt."""
+
+    model_cls = kwargs.get('model_cls', orm.NotificationDispatch)
+    if not notification_dispatch_ids:
+        return 0
+
+    now = now or datetime.datetime.now()
+    next_attempt = now + datetime.timedelta(seconds=seconds)
+    query = model_cls.query.filter(any_of(model_cls.id, notification_dispatch_ids))
+    return query.update({'next_attempt': next_attempt, 'claimed_at': None,
+            'claimed_by': None}, synchronize_session=False)
+
+
+def mark_read(criteria, now=None, **kwargs):
+    """Set the read date of the unread notifications matching the criteria
+    with one update and take them off their users' unread counts, returning
+    how many were updated."""
+
+    model_cls = kwargs.get('model_cls', orm.Notification)
+    session = kwargs.get('session', bm.Session)
+
+    now = now or datetime.datetime.now()
+    table = model_cls.__table__
+    statement = table.update().where(sql.and_(model_cls.read == None, *criteria))
+    statement = statement.values(read=now).returning(table.c.user_id)
+    user_ids = [row[0] for row in session.execute(statement)]
+    decrement_unread_counts(user_ids, session=session)
+    return len(user_ids)
+
+def mark_notifications_read(notification_ids, now=None, user_id=None, **kwargs):
+    """Set the read date of many unread notifications with one update,
+    returning how many were updated. Only the ones belonging to the user
+    are updated if given a ``user_id``."""
+
+    model_cls = kwargs.get('model_cls', orm.Notification)
+    if not notification_ids:
+        return 0
+
+    criteria = [any_of(model_cls.id, notification_ids)]
+    if user_id is not None:
+        criteria.append(model_cls.user_id == user_id)
+    return mark_read(criteria, now, **kwargs)
+
+def mark_user_notifications_read(user_id, before=None, now=None, **kwargs):
+    """Set the read date of all of the user's unread notifications created
+    before the given naive UTC date with one update, returning how many were
+    updated."""
+
+    model_cls = kwargs.get('model_cls', orm.Notification)
+
+    criteria = [model_cls.user_id == user_id]
+    if before is not None:
+        criteria.append(model_cls.created < before)
+    return mark_read(criteria, now, **kwargs)
+
+def bind_counts(query, counts):
+    """Bind the user ids and their counts, in user id order, to the query as
+    the two array parameters ``:user_ids`` and ``:counts``."""
+
+    user_ids = sorted(counts)
+    query = query.bindparams(
+            sql.bindparam('user_ids', user_ids, type_=postgresql.ARRAY(types.Integer)),
+            sql.bindparam('counts', [counts[k] for k in user_ids],
+                    type_=postgresql.ARRAY(types.Integer)))
+    return query
+
+def increment_unread_counts(user_ids, **kwargs):
+    """Add one to the unread count of the user for each time its id is given,
+    creating the counts that don't exist yet. Uses one statement, taking the
+    row locks in user id order so that concurrent updates can't deadlock."""
+
+    model_cls = kwargs.get('model_cls', orm.NotificationUnreadCount)
+    session = kwargs.get('session', bm.Session)
+
+    counts = collections.Counter(user_ids)
+    if not counts:
+        return
+    query = sql.text("""
+        INSERT INTO {table} (user_id, unread)
+             SELECT c.user_id, c.count
+               FROM unnest(:user_ids, :counts) AS c(user_id, count)
+              ORDER BY 1
+            ON CONFLICT (user_id) DO UPDATE SET unread = {table}.unread + excluded.unread
+    """.format(table=model_cls.__tablename__))
+    session.execute(bind_counts(query, counts))
+
+def decrement_unread_counts(user_ids, **kwargs):
+    """Take one off the unread count of the user for each time its id is
+    given. Uses one statement, locking the rows in user id order first so
+    that concurrent updates can't deadlock."""
+
+    model_cls = kwargs.get('model_cls', orm.NotificationUnreadCount)
+    session = kwargs.get('session', bm.Session)
+
+    counts = collections.Counter(user_ids)
+    if not counts:
+        return
+    query = sql.text("""
+        WITH locked AS (
+            SELECT user_id FROM {table}
+             WHERE user_id = ANY(:user_ids)
+             ORDER BY user_id
+               FOR UPDATE)
+        UPDATE {table} t SET unread = GREATEST(t.unread - c.count, 0)
+          FROM unnest(:user_ids, :counts) AS c(user_id, count), locked
+         WHERE t.user_id = c.user_id AND locked.user_id = c.user_id
+    """.format(table=model_cls.__tablename__))
+    session.execute(bind_counts(query, counts))
+
+def get_unread_count(user_id, **kwargs):
+    """Get the user's unread notification count."""
+
+    model_cls = kwargs.get('model_cls', orm.NotificationUnreadCount)
+
+    count = model_cls.query.get(user_id)
+    return count.unread if count else 0
+
+def reconcile_unread_counts(**kwargs):
+    """Recount the unread notifications of every user, to correct any drift
+    in the denormalised counts."""
+
+    model_cls = kwargs.get('model_cls', orm.NotificationUnreadCount)
+    notification_cls = kwargs.get('notification_cls', orm.Notification)
+    session = kwargs.get('session', bm.Session)
+
+    tables = {
+        'counts': model_cls.__tablename__,
+        'notifications': notification_cls.__tablename__,
+    }
+    session.execute(sql.text("""
+        INSERT INTO {counts} (user_id, unread)
+             SELECT user_id, count(*) FROM {notifications}
+              WHERE read IS NULL AND user_id IS NOT NULL
+              GROUP BY user_id
+            ON CONFLICT (user_id) DO UPDATE SET unread = excluded.unread
+    """.format(**tables)))
+    session.execute(sql.text("""
+        UPDATE {counts} SET unread = 0
+         WHERE unread != 0 AND NOT EXISTS (
+            SELECT 1 FROM {notifications} n
+             WHERE n.user_id = {counts}.user_id AND n.read IS NULL)
+    """.format(**tables)))
+
+def take_tokens(key, rate, burst, count=1, take=True, **kwargs):
+    """Take ``count`` tokens from the ``key`` bucket, which refills at
+    ``rate`` tokens per second up to ``burst``. Returns 0 if they were
+    taken or else how many seconds to wait until there are enough. Only
+    checks that there are enough, without taking them, if not ``take``.
+
+    Runs in a transaction of its own, using the db clock, so the bucket is
+    shared by all of the processes without being locked for the rest of
+    their transaction.
+    """
+
+    model_cls = kwargs.get('model_cls', orm.NotificationRateLimit)
+    bind = kwargs.get('bind') or bm.Session.get_bind()
+
+    table = model_cls.__tablename__
+    params = {'key': key, 'rate': rate, 'burst': burst, 'count': count,
+            'take': take}
+    connection = bind.connect()
+    try:
+        with connection.begin():
+            connection.execute(sql.text("""
+                INSERT INTO {table} (key, tokens, updated) VALUES (:key, :burst, now())
+                    ON CONFLICT (key) DO NOTHING
+            """.format(table=table)), params)
+            tokens = connection.execute(sql.text("""
+                UPDATE {table} b
+                   SET tokens = CASE WHEN :take AND r.tokens >= :count
+                                     THEN r.tokens - :count ELSE r.tokens END,
+                       updated = GREATEST(b.updated, now())
+                  FROM (SELECT key, LEAST(:burst, tokens + :rate * GREATEST(
+                               EXTRACT(EPOCH FROM now() - updated), 0)) AS tokens
+                          FROM {table} WHERE key = :key FOR UPDATE) r
+                 WHERE b.key = r.key
+             RETURNING r.tokens
+            """.format(table=table)), params).scalar()
+    finally:
+        connection.close()
+    if tokens >= count:
+        return 0
+    return (count - tokens) / float(rate)
+
+def notify_due(session):
+    """Notify the listening executer, when the transaction commits, that
+    there are dispatches due now."""
+
+    session.execute(sql.text('NOTIFY {0}'.format(NOTIFY_CHANNEL)))
+
+def insert_defaults(table):
+    """Evaluate the python side defaults of the table's columns, which a raw
+    insert wouldn't otherwise apply."""
+
+    values = {}
+    for column in table.columns:
+        default = column.default
+        if column.primary_key or default is None:
+            continue
+        if default.is_callable:
+            values[column.name] = default.arg(None)
+        elif default.is_scalar:
+            values[column.name] = default.arg
+    return values
+
+def insert_notification_preferences(user_ids, frequency=None, channel=u'email', **kwargs):
+    """Create the notification preferences of the users who don't have any
+    yet with one insert, which skips the ones a concurrent transaction has
+    created rather than failing. Returns the ids of the users they were
+    created for."""
+
+    model_cls = kwargs.get('model_cls', orm.NotificationPreference)
+    session = kwargs.get('session', bm.Session)
+    if not user_ids:
+        return []
+
+    values = insert_defaults(model_cls.__table__)
+    values.update(frequency=frequency, channel=channel)
+    columns = sorted(values)
+    query = sql.text("""
+        INSERT INTO {table} (user_id, {columns})
+             SELECT u.user_id, {params}
+               FROM unnest(:user_ids) AS u(user_id)
+              ORDER BY 1
+            ON CONFLICT (user_id) DO NOTHING
+        RETURNING user_id
+    """.format(table=model_cls.__tablename__, columns=', '.join(columns),
+            params=', '.join(':' + column for column in columns)))
+    query = query.bindparams(sql.bindparam('user_ids', sorted(user_ids),
+            type_=postgresql.ARRAY(types.Integer)))
+    return [row[0] for row in session.execute(query, values)]
+
 def get_or_create_notification_preferences(user):
     """Gets or creates the notification preferences for the user."""
     notification_preference_factory = NotificationPreferencesFactory()
@@ -107,6 +835,22 @@ def get_or_create_notification_preferences(user):
     if preference is None:
         preference = notification_preference_factory(user.id)
         bm.Session.add(user)
+        bm.Session.expire(user, ['notification_preference'])
+    return preference
+
+def update_notification_preferences(user_id, **kwargs):
+    """Updates the user's notification preferences, creating them if needs
+    be, and drops them from this process' cache."""
+
+    model_cls = kwargs.pop('model_cls', orm.NotificationPreference)
+    session = kwargs.pop('session', bm.Session)
+
+    insert_notification_preferences([user_id], model_cls=model_cls, session=session)
+    preference = model_cls.query.filter_by(user_id=user_id).one()
+    for key, value in kwargs.items():
+        setattr(preference, key, value)
+    session.flush()
+    preference_cache.invalidate(user_id)
     return preference
 
 class NotificationPreferencesFactory(object):
@@ -118,17 +862,16 @@ class NotificationPreferencesFactory(object):
         self.session = kwargs.get('session', bm.Session)
 
     def __call__(self, user_id, frequency=None, channel='email'):
-        """Create and store a notification and a notification dispatch."""
+        """Create and store the user's notification preferences, unless a
+        concurrent transaction has already, and return them."""
 
         # Unpack.
         session = self.session
+        model_cls = self.notification_preference_cls
 
-        # Create notification.
-        notification_preference = self.notification_preference_cls(
-                user_id=user_id, frequency=frequency, channel=channel)
-
-        # Save to the database.
-        session.add(notification_preference)
-        session.flush()
+        # Save to the database, if they don't exist yet.
+        insert_notification_preferences([user_id], frequency, channel,
+                model_cls=model_cls, session=session)
+        preference_cache.invalidate(user_id)
 
-        return notification_preference
+        return model_cls.query.filter_by(user_id=user_id).one()
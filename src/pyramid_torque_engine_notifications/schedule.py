@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+"""Work out when notifications are due, for many recipients at once."""
+
+__all__ = [
+    'Scheduler',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import collections
+import datetime
+import hashlib
+
+from dateutil import tz
+
+# Daily notifications are normalised to 20h of each day.
+DAILY_HOUR = 20
+# The windows, in minutes, that the due dates of each frequency are spread
+# over, so that they don't all fall due at the same instant.
+SPREAD = {
+    'daily': 60,
+    'hourly': 10,
+}
+PERIODS = {
+    'daily': datetime.timedelta(days=1),
+    'hourly': datetime.timedelta(hours=1),
+}
+
+
+def to_naive_local(value):
+    """Our dates are stored as naive local times."""
+
+    return value.astimezone(tz.tzlocal()).replace(tzinfo=None)
+
+
+def get_offset(user_id, window):
+    """Get the user's offset into the window, in seconds. It's derived from
+    the user id, so each user's digest goes out at the same time every day."""
+
+    if user_id is None or not window:
+        return 0
+    digest = hashlib.md5(str(user_id)).hexdigest()
+    return int(digest[:8], 16) % (window * 60)
+
+
+class Scheduler(object):
+    """Computes due dates from the users' frequency preference and
+      timezone, spreading them over a window per frequency and deferring
+      the ones that fall within the quiet hours. ``spread`` maps the
+      frequencies to their window in minutes and ``quiet_hours`` is a
+      ``(start, end)`` tuple of hours in the user's timezone, which wraps
+      around midnight if ``start > end``.
+    """
+
+    def __init__(self, **kwargs):
+        self.daily_hour = kwargs.get('daily_hour', DAILY_HOUR)
+        self.spread = kwargs.get('spread', SPREAD)
+        self.quiet_hours = kwargs.get('quiet_hours', None)
+        self.default_tz = kwargs.get('default_tz', tz.tzlocal())
+        for frequency, window in self.spread.items():
+            period = PERIODS.get(frequency)
+            if period and datetime.timedelta(minutes=window) >= period:
+                raise ValueError('The {0} spread must be shorter than {1}'.format(
+                        frequency, period))
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Configure from the ``notification.daily_hour``, e.g.:
+        ``notification.quiet_hours = 22-7`` and the
+        ``notification.daily_spread`` and ``notification.hourly_spread``
+        settings, in minutes."""
+
+        kwargs = {}
+        daily_hour = settings.get('notification.daily_hour')
+        if daily_hour:
+            kwargs['daily_hour'] = int(daily_hour)
+        quiet_hours = settings.get('notification.quiet_hours')
+        if quiet_hours:
+            start, end = quiet_hours.split('-')
+            kwargs['quiet_hours'] = (int(start), int(end))
+        spread = dict(SPREAD)
+        for frequency in spread:
+            window = settings.get('notification.{0}_spread'.format(frequency))
+            if window is not None:
+                spread[frequency] = int(window)
+        kwargs['spread'] = spread
+        return cls(**kwargs)
+
+    def get_tz(self, timezone):
+        """Get the user's timezone, falling back on the default one."""
+
+        user_tz = tz.gettz(timezone) if timezone else None
+        if user_tz is None:
+            return self.default_tz
+        return user_tz
+
+    def get_period_start(self, frequency, now):
+        """Get the start of the current period of the frequency, i.e.: the
+        last daily hour or the top of the hour, or None if it has none."""
+
+        if frequency == 'daily':
+            start = now.replace(hour=self.daily_hour, minute=0, second=0, microsecond=0)
+            if start > now:
+                start = start - PERIODS['daily']
+            return start
+
+        # Whole hours are worked out in UTC, as not all offsets are.
+        elif frequency == 'hourly':
+            return now.astimezone(tz.tzutc()).replace(minute=0, second=0, microsecond=0)
+
+        return None
+
+    def due(self, frequency, delay=None, timezone=None, now=None, user_id=None):
+        """Get the due date, as a naive local time, for one recipient."""
+
+        recipients = [(user_id, frequency, timezone)]
+        return self.schedule(recipients, delay, now)[user_id]
+
+    def after_quiet_hours(self, due):
+        """Move the due date to the end of the quiet hours, if within them."""
+
+        if not self.quiet_hours:
+            return due
+
+        start, end = self.quiet_hours
+        hour = due.hour
+        if start <= end:
+            is_quiet = start <= hour < end
+        else:
+            is_quiet = hour >= start or hour < end
+        if not is_quiet:
+            return due
+
+        end_of_quiet = due.replace(hour=end, minute=0, second=0, microsecond=0)
+        if end_of_quiet < due:
+            end_of_quiet = end_of_quiet + datetime.timedelta(days=1)
+        return end_of_quiet
+
+    def schedule(self, recipients, delay=None, now=None):
+        """Map each of the ``(user_id, frequency, timezone)`` recipients to
+        its due date: the first time, from now, that falls at the user's
+        offset into the period of its frequency. The period is worked out
+        once for all of the recipients that share a frequency and timezone."""
+
+        # Unpack.
+        if now is None:
+            now = datetime.datetime.now(tz.tzutc())
+        elif now.tzinfo is None:
+            now = now.replace(tzinfo=tz.tzlocal())
+        delay = datetime.timedelta(minutes=delay or 0)
+
+        # Bucket the recipients.
+        buckets = collections.defaultdict(list)
+        for user_id, frequency, timezone in recipients:
+            buckets[(frequency, timezone)].append(user_id)
+
+        # Compute the period once per bucket and offset each user into it.
+        due_dates = {}
+        for (frequency, timezone), user_ids in buckets.items():
+            user_tz = self.get_tz(timezone)
+            local_now = now.astimezone(user_tz)
+            start = self.get_period_start(frequency, local_now)
+            window = self.spread.get(frequency, 0)
+            for user_id in user_ids:
+                if start is None:
+                    due = local_now
+                else:
+                    offset = get_offset(user_id, window)
+                    due = start + datetime.timedelta(seconds=offset)
+                    if due < local_now:
+                        due = due + PERIODS[frequency]
+                due = (due + delay).astimezone(user_tz)
+                due_dates[user_id] = to_naive_local(self.after_quiet_hours(due))
+        return due_dates
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+"""Provides senders that deliver rendered notification emails and record
+  when their notification dispatches were sent.
+"""
+
+__all__ = [
+    'SingleEmailSender',
+    'PostmarkBatchSender',
+    'get_notification_sender',
+    'mark_sent',
+    'mark_failed',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import json
+import requests
+import time
+
+from . import repo
+
+# Postmark accepts up to 500 messages per batch.
+POSTMARK_BATCH_URL = 'https://api.postmarkapp.com/email/batch'
+POSTMARK_BATCH_SIZE = 500
+
+
+def mark_sent(notification_dispatches):
+    """Set the sent info of the notification dispatches in our db."""
+
+    repo.mark_dispatches_sent([d.id for d in notification_dispatches])
+
+
+def mark_failed(failures):
+    """Record the ``(notification_dispatch, error)`` failures in our db, so
+    that they're retried later."""
+
+    repo.mark_dispatches_failed([(d.id, error) for d, error in failures])
+
+
+class SingleEmailSender(object):
+    """Sends each email with ``request.send_email`` as soon as it's given."""
+
+    def __init__(self, request, **kwargs):
+        self.request = request
+        self.mark_sent = kwargs.get('mark_sent', mark_sent)
+
+    def __call__(self, email, notification_dispatches):
+        """Send the email and mark its notification dispatches as sent."""
+
+        self.request.send_email(email)
+        self.mark_sent(notification_dispatches)
+
+    def flush(self):
+        """A no-op. Emails are sent straight away."""
+
+        return []
+
+
+class PostmarkBatchSender(object):
+    """Collects emails and sends them through the Postmark batch API once
+      ``max_size`` emails are pending or the oldest one has been waiting for
+      ``max_wait`` seconds. The emails should provide ``to_json_message()``,
+      as ``postmark.PMMail`` does.
+    """
+
+    def __init__(self, request, **kwargs):
+        settings = request.registry.settings
+        self.url = settings.get('notification.postmark_batch_url', POSTMARK_BATCH_URL)
+        self.api_key = settings.get('postmark.api_key')
+        self.max_size = min(int(settings.get('notification.batch_size',
+                POSTMARK_BATCH_SIZE)), POSTMARK_BATCH_SIZE)
+        self.max_wait = float(settings.get('notification.batch_wait', 5))
+        self.timeout = float(settings.get('notification.batch_timeout', 30))
+        self.mark_sent = kwargs.get('mark_sent', mark_sent)
+        self.mark_failed = kwargs.get('mark_failed', mark_failed)
+        self.session = kwargs.get('session_cls', requests.Session)()
+        self.pending = []
+        self.failed = []
+        self.started = None
+
+    def __call__(self, email, notification_dispatches):
+        """Queue the email, flushing if the batch is full or has waited long
+        enough."""
+
+        if not self.pending:
+            self.started = time.time()
+        self.pending.append((email, notification_dispatches))
+        if len(self.pending) >= self.max_size:
+            self.failed = self.flush()
+        elif time.time() - self.started >= self.max_wait:
+            self.failed = self.flush()
+
+    def flush(self):
+        """Send the pending emails in one request, marking the dispatches of
+        the ones Postmark accepted as sent and recording the failures of the
+        others. Returns the dispatches of all the emails that failed since
+        the last explicit flush.
+        """
+
+        pending, self.pending = self.pending, []
+        failed, self.failed = self.failed, []
+        if not pending:
+            return failed
+
+        # Post the batch.
+        headers = {
+            'Accept': 'application/json',
+            'Content-Type': 'application/json',
+            'X-Postmark-Server-Token': self.api_key,
+        }
+        messages = [email.to_json_message() for email, _ in pending]
+        try:
+            r = self.session.post(self.url, data=json.dumps(messages),
+                    headers=headers, timeout=self.timeout)
+            r.raise_for_status()
+            results = r.json()
+        except (requests.RequestException, ValueError) as err:
+            logger.warn('Notification: failed to send email batch: {0}'.format(err))
+            dispatches = [d for _, dispatches in pending for d in dispatches]
+            self.mark_failed([(d, err) for d in dispatches])
+            return failed + dispatches
+
+        # Map each result back to its dispatches.
+        sent = []
+        failures = []
+        for (email, dispatches), result in zip(pending, results):
+            if result.get('ErrorCode') == 0:
+                sent.extend(dispatches)
+            else:
+                logger.warn('Notification: failed to send email to {0}: {1}'.format(
+                        result.get('To'), result.get('Message')))
+                failures.extend((d, result.get('Message')) for d in dispatches)
+                failed.extend(dispatches)
+        self.mark_sent(sent)
+        self.mark_failed(failures)
+        return failed
+
+
+def get_notification_sender(request):
+    """Get the email sender configured by the ``notification.sender``
+    setting, either ``single`` (the default) or ``postmark_batch``."""
+
+    # Unpack.
+    settings = request.registry.settings
+
+    name = settings.get('notification.sender', 'single')
+    if name == 'postmark_batch':
+        return PostmarkBatchSender(request)
+    elif name == 'single':
+        return SingleEmailSender(request)
+    raise Exception('Unknown notification sender {0}'.format(name))
@@ -5,23 +5,50 @@
 import logging
 logger = logging.getLogger(__name__)
 
+import datetime
 import json
 import fysom
+import threading
 import transaction
 import mock
 
 import pyramid_basemodel as bm
 
 from pyramid import config as pyramid_config
+from repoze.lru import LRUCache
 
 from pyramid_torque_engine import constants
 from pyramid_torque_engine import operations as ops
 from pyramid_torque_engine import unpack
 from pyramid_torque_engine import repo as te_repo
+from pyramid_torque_engine_notifications import channels
+from pyramid_torque_engine_notifications import notification as n
+from pyramid_torque_engine_notifications import notification_executer
 from pyramid_torque_engine_notifications import repo
+from pyramid_torque_engine_notifications import sender
 
 a, o, r, s = unpack.constants()
 
+DISPATCH_MAPPING = {
+    'email': {
+        'view': __name__ + '.dummy_view',
+        'single': 'templates/single.mako',
+        'batch': 'templates/batch.mako',
+    },
+}
+
+def dummy_view(request, context, send_to, event, action):
+    return {}
+
+@n.recipient_independent
+def independent_view(request, context, send_to, event, action):
+    return {'to': send_to, 'title': u'Done'}
+
+class Email(object):
+    def __init__(self, to):
+        self.to = to
+        self.bcc = None
+
 from . import boilerplate
 from . import model
 
@@ -93,3 +120,531 @@ class TestNotifications(boilerplate.AppTestCase):
             notification_preference = user.notification_preference
             self.assertIsNone(notification_preference.frequency)
             self.assertEqual(notification_preference.channel, 'email')
+
+    def test_batch_dispatch(self):
+        """Test a user's dispatches are sent as one digest."""
+
+        factory = repo.NotificationFactory(mock.Mock())
+        lookup = repo.LookupNotificationDispatch()
+        request = mock.Mock()
+        request.registry.settings = {}
+        request.notification_sender = sender.SingleEmailSender(request)
+        request.registry.notification_channels = {
+            'email': channels.EmailChannel(request.registry.settings),
+        }
+
+        # Create an event and get it back.
+        context = model.factory()
+        event_id = boilerplate.createEvent(context)
+        event = te_repo.LookupActivityEvent()(event_id)
+
+        with transaction.manager:
+            user = boilerplate.createUser()
+            bm.Session.add(event)
+            notifications = [factory(event, user, DISPATCH_MAPPING) for i in range(3)]
+            ids = [d.id for x in notifications for d in x.notification_dispatch]
+
+        with transaction.manager:
+            dispatches = lookup.by_ids(ids)
+            self.assertEqual(len(dispatches), 3)
+            r = n.send_from_notification_dispatches(request, dispatches)
+
+            # One email was rendered with the batch spec and sent.
+            self.assertEqual(r, 3)
+            self.assertEqual(request.render_email.call_count, 1)
+            self.assertEqual(request.render_email.call_args[0][3], 'templates/batch.mako')
+            self.assertEqual(request.send_email.call_count, 1)
+
+        with transaction.manager:
+            # They are all marked as sent.
+            self.assertEqual(lookup.by_ids(ids), [])
+
+    def test_recipient_independent_dispatch(self):
+        """Test each recipient of a recipient independent view gets their
+        own ``to``, though the email is only rendered once.
+        """
+
+        factory = repo.BulkNotificationFactory(mock.Mock())
+        lookup = repo.LookupNotificationDispatch()
+        request = mock.Mock()
+        request.registry.settings = {}
+        request.notification_render_cache = LRUCache(10)
+        request.render_email.side_effect = lambda f, to, *args, **kw: Email(to)
+        request.registry.notification_channels = {
+            'email': channels.EmailChannel(request.registry.settings),
+        }
+        mapping = {
+            'email': {
+                'view': __name__ + '.independent_view',
+                'single': 'templates/single.mako',
+                'batch': 'templates/batch.mako',
+            },
+        }
+
+        # Create an event and get it back.
+        context = model.factory()
+        event_id = boilerplate.createEvent(context)
+        event = te_repo.LookupActivityEvent()(event_id)
+
+        with transaction.manager:
+            users = [boilerplate.createUser(name=u'user{0}'.format(i)) for i in range(2)]
+            bm.Session.add(event)
+            notification_ids = factory(event, users, mapping)
+
+        addresses = [u'first@example.com', u'second@example.com']
+        with transaction.manager:
+            now = datetime.datetime.now()
+            dispatches = lookup.due_by_notification_ids(notification_ids, now)
+            self.assertEqual(len(dispatches), 2)
+            for dispatch, address in zip(dispatches, addresses):
+                dispatch.address = address
+            for dispatch in dispatches:
+                self.assertEqual(n.send_notification_dispatch(request, dispatch), n.SENT)
+
+        # Rendered once, but sent to each of them.
+        self.assertEqual(request.render_email.call_count, 1)
+        emails = [call[0][0] for call in request.notification_sender.call_args_list]
+        self.assertEqual([email.to for email in emails], addresses)
+
+    def test_dispatch_after_commit(self):
+        """Test the due dispatches are sent in the background once the
+        transaction has been committed.
+        """
+
+        factory = repo.BulkNotificationFactory(mock.Mock())
+        lookup = repo.LookupNotificationDispatch()
+        request = mock.Mock()
+        request.registry.settings = {}
+        request.notification_sender = sender.SingleEmailSender(request)
+        request.registry.notification_channels = {
+            'email': channels.EmailChannel(request.registry.settings),
+        }
+        prepare = lambda registry: {'request': request, 'closer': mock.Mock()}
+        dispatcher = n.NotificationDispatcher(request.registry, prepare=prepare)
+        request.registry.notification_dispatcher = dispatcher
+
+        # Create an event and get it back.
+        context = model.factory()
+        event_id = boilerplate.createEvent(context)
+        event = te_repo.LookupActivityEvent()(event_id)
+
+        with transaction.manager:
+            users = [boilerplate.createUser(name=u'user{0}'.format(i)) for i in range(2)]
+            bm.Session.add(event)
+            notification_ids = factory(event, users, DISPATCH_MAPPING)
+            n.dispatch_notifications_after_commit(request, notification_ids)
+
+            # Nothing is sent before the commit.
+            self.assertEqual(request.send_email.call_count, 0)
+
+        # Wait for the dispatcher to send them.
+        dispatcher.queue.join()
+        self.assertEqual(request.send_email.call_count, 2)
+
+        with transaction.manager:
+            # They are all marked as sent.
+            now = datetime.datetime.now()
+            self.assertEqual(lookup.due_by_notification_ids(notification_ids, now), [])
+
+    def test_no_dispatch_after_abort(self):
+        """Test nothing is sent when the transaction is aborted."""
+
+        factory = repo.BulkNotificationFactory(mock.Mock())
+        request = mock.Mock()
+        dispatcher = n.NotificationDispatcher(request.registry, prepare=mock.Mock())
+        request.registry.notification_dispatcher = dispatcher
+
+        # Create an event and get it back.
+        context = model.factory()
+        event_id = boilerplate.createEvent(context)
+        event = te_repo.LookupActivityEvent()(event_id)
+
+        transaction.begin()
+        user = boilerplate.createUser()
+        bm.Session.add(event)
+        notification_ids = factory(event, [user], DISPATCH_MAPPING)
+        n.dispatch_notifications_after_commit(request, notification_ids)
+        transaction.abort()
+
+        # Nothing was queued or sent.
+        self.assertTrue(dispatcher.queue.empty())
+        self.assertIsNone(dispatcher.thread)
+        self.assertEqual(dispatcher.prepare.call_count, 0)
+
+    def test_dispatch_after_commit_claims(self):
+        """Test the dispatches handed to the background dispatcher are
+        claimed, so the executer woken up by the commit skips them.
+        """
+
+        factory = repo.BulkNotificationFactory(mock.Mock())
+        lookup = repo.LookupNotificationDispatch()
+        request = mock.Mock()
+        request.registry.notification_dispatcher.worker_id = u'dispatcher'
+
+        # Create an event and get it back.
+        context = model.factory()
+        event_id = boilerplate.createEvent(context)
+        event = te_repo.LookupActivityEvent()(event_id)
+
+        with transaction.manager:
+            user = boilerplate.createUser()
+            bm.Session.add(event)
+            notification_ids = factory(event, [user], DISPATCH_MAPPING)
+            n.dispatch_notifications_after_commit(request, notification_ids)
+
+        dispatcher = request.registry.notification_dispatcher
+        self.assertEqual(dispatcher.enqueue.call_count, 1)
+        dispatch_ids = dispatcher.enqueue.call_args[0][0]
+        self.assertEqual(len(dispatch_ids), 1)
+
+        with transaction.manager:
+            # Neither the scan nor the workers pick them up.
+            now = datetime.datetime.now()
+            self.assertEqual(lookup.due_by_notification_ids(notification_ids, now), [])
+            self.assertEqual(repo.ClaimNotificationDispatches(u'executer')(10), [])
+
+            # Unless the dispatcher doesn't get round to them within the lease.
+            later = now + datetime.timedelta(seconds=repo.CLAIM_LEASE + 1)
+            self.assertEqual(len(lookup.due_by_notification_ids(notification_ids, later)), 1)
+
+    def test_serve_wakes_on_notify(self):
+        """Test the executer dispatches as soon as it's notified that there
+        are due dispatches, rather than waiting for its next poll.
+        """
+
+        engine = self.factory.engine
+        stopping = []
+        calls = []
+        listening = threading.Event()
+        woken = threading.Event()
+
+        def dispatch():
+            calls.append(None)
+            (woken if len(calls) > 1 else listening).set()
+            return False
+
+        def notify():
+            connection = engine.raw_connection()
+            try:
+                connection.connection.set_isolation_level(0)
+                connection.cursor().execute('NOTIFY {0}'.format(repo.NOTIFY_CHANNEL))
+            finally:
+                connection.close()
+
+        with mock.patch.object(notification_executer, 'NOTIFICATION_POLL_MIN', 60):
+            thread = threading.Thread(target=notification_executer.serve,
+                    args=(engine, dispatch, stopping))
+            thread.daemon = True
+            thread.start()
+            self.assertTrue(listening.wait(5))
+
+            # It's woken up straight away.
+            notify()
+            self.assertTrue(woken.wait(5))
+
+            # And stops once asked to.
+            stopping.append(True)
+            notify()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+    def test_bulk_notification_factory(self):
+        """Test notifications are created in bulk for many users."""
+
+        factory = repo.BulkNotificationFactory(mock.Mock())
+        lookup = repo.LookupNotificationDispatch()
+
+        # Create an event and get it back.
+        context = model.factory()
+        event_id = boilerplate.createEvent(context)
+        event = te_repo.LookupActivityEvent()(event_id)
+
+        with transaction.manager:
+            users = [boilerplate.createUser(name=u'user{0}'.format(i)) for i in range(3)]
+            bm.Session.add(event)
+            notification_ids = factory(event, users, DISPATCH_MAPPING)
+            user_ids = [user.id for user in users]
+
+            # A notification with its dispatch was created for each user.
+            self.assertEqual(len(notification_ids), 3)
+            for notification_id in notification_ids:
+                dispatches = lookup.by_notification_id(notification_id)
+                self.assertEqual(len(dispatches), 1)
+                self.assertEqual(dispatches[0].category, 'email')
+
+            # And their default preferences.
+            preferences = repo.LookupNotificationPreference().by_user_ids(user_ids)
+            self.assertEqual(sorted(preferences), sorted(user_ids))
+
+    def test_coalesce_notifications(self):
+        """Test pending notifications about the same context are coalesced."""
+
+        factory = repo.BulkNotificationFactory(mock.Mock())
+        lookup = repo.LookupNotification()
+
+        # Create two events about the same context and get them back.
+        context = model.factory()
+        first_id = boilerplate.createEvent(context)
+        second_id = boilerplate.createEvent(context)
+        first = te_repo.LookupActivityEvent()(first_id)
+        second = te_repo.LookupActivityEvent()(second_id)
+
+        with transaction.manager:
+            user = boilerplate.createUser()
+            bm.Session.add_all([first, second])
+            notification_ids = factory(first, [user, user], DISPATCH_MAPPING, coalesce=10)
+
+            # Sending the first event failed.
+            dispatch_ids = [d.id for d in lookup(notification_ids[0]).notification_dispatch]
+            repo.mark_dispatches_failed([(id_, u'Boom') for id_ in dispatch_ids])
+
+            coalesced_ids = factory(second, [user], DISPATCH_MAPPING, coalesce=10)
+            user_id = user.id
+
+        with transaction.manager:
+            # The user was notified once, about the latest event.
+            self.assertEqual(len(notification_ids), 1)
+            self.assertEqual(coalesced_ids, notification_ids)
+            notification = lookup(notification_ids[0])
+            self.assertEqual(notification.event_id, second_id)
+            self.assertEqual(len(notification.notification_dispatch), 1)
+            self.assertEqual(repo.get_unread_count(user_id), 1)
+
+            # Sending the latest event starts over.
+            dispatch = notification.notification_dispatch[0]
+            self.assertEqual(dispatch.attempts, 0)
+            self.assertIsNone(dispatch.last_error)
+            self.assertIsNone(dispatch.next_attempt)
+
+    def test_coalesce_skips_claimed(self):
+        """Test notifications whose dispatches are claimed, and may be being
+        sent, aren't coalesced into.
+        """
+
+        factory = repo.BulkNotificationFactory(mock.Mock())
+
+        # Create two events about the same context and get them back.
+        context = model.factory()
+        first_id = boilerplate.createEvent(context)
+        second_id = boilerplate.createEvent(context)
+        first = te_repo.LookupActivityEvent()(first_id)
+        second = te_repo.LookupActivityEvent()(second_id)
+
+        with transaction.manager:
+            user = boilerplate.createUser()
+            bm.Session.add_all([first, second])
+            notification_ids = factory(first, [user], DISPATCH_MAPPING, coalesce=10)
+            user_id = user.id
+
+        with transaction.manager:
+            self.assertEqual(len(repo.ClaimNotificationDispatches(u'a')(10)), 1)
+
+        with transaction.manager:
+            bm.Session.add(second)
+            user = bm.Session.merge(user)
+            other_ids = factory(second, [user], DISPATCH_MAPPING, coalesce=10)
+
+        with transaction.manager:
+            # The user gets a new notification about the latest event.
+            self.assertEqual(len(other_ids), 1)
+            self.assertNotEqual(other_ids, notification_ids)
+            self.assertEqual(repo.get_unread_count(user_id), 2)
+
+    def test_claim_notification_dispatches(self):
+        """Test workers claim distinct due dispatches."""
+
+        factory = repo.BulkNotificationFactory(mock.Mock())
+
+        # Create an event and get it back.
+        context = model.factory()
+        event_id = boilerplate.createEvent(context)
+        event = te_repo.LookupActivityEvent()(event_id)
+
+        with transaction.manager:
+            users = [boilerplate.createUser(name=u'user{0}'.format(i)) for i in range(3)]
+            bm.Session.add(event)
+            factory(event, users, DISPATCH_MAPPING)
+
+        with transaction.manager:
+            first = repo.ClaimNotificationDispatches(u'a')(2)
+            second = repo.ClaimNotificationDispatches(u'b')(2)
+            third = repo.ClaimNotificationDispatches(u'c')(2)
+
+            # The due dispatches were shared between the workers.
+            self.assertEqual(len(first), 2)
+            self.assertEqual(len(second), 1)
+            self.assertEqual(third, [])
+            self.assertFalse(set(first).intersection(second))
+
+    def test_failed_dispatches_back_off(self):
+        """Test failed dispatches back off and die after too many attempts."""
+
+        factory = repo.BulkNotificationFactory(mock.Mock())
+        lookup = repo.LookupNotificationDispatch()
+
+        # Create an event and get it back.
+        context = model.factory()
+        event_id = boilerplate.createEvent(context)
+        event = te_repo.LookupActivityEvent()(event_id)
+
+        with transaction.manager:
+            user = boilerplate.createUser()
+            bm.Session.add(event)
+            notification_ids = factory(event, [user], DISPATCH_MAPPING)
+
+        now = datetime.datetime.now()
+        with transaction.manager:
+            dispatch_id = lookup.due_by_notification_ids(notification_ids, now)[0].id
+            repo.mark_dispatches_failed([(dispatch_id, u'Boom')], now=now,
+                    max_attempts=2)
+
+        with transaction.manager:
+            # It's no longer due until it has backed off.
+            self.assertEqual(lookup.due_by_notification_ids(notification_ids, now), [])
+            later = now + datetime.timedelta(seconds=repo.BACKOFF_BASE)
+            dispatches = lookup.due_by_notification_ids(notification_ids, later)
+            self.assertEqual(dispatches[0].attempts, 1)
+            self.assertEqual(dispatches[0].last_error, u'Boom')
+            repo.mark_dispatches_failed([(dispatch_id, u'Boom')], now=later,
+                    max_attempts=2)
+
+        with transaction.manager:
+            # It's dead after the second attempt.
+            dispatch = lookup(dispatch_id)
+            self.assertEqual(dispatch.attempts, 2)
+            self.assertIsNotNone(dispatch.dead)
+            much_later = later + datetime.timedelta(days=1)
+            self.assertEqual(lookup.due_by_notification_ids(notification_ids,
+                    much_later), [])
+
+    def test_take_tokens(self):
+        """Test the token buckets are shared through the db."""
+
+        # The burst is taken straight away.
+        self.assertEqual(repo.take_tokens(u'test', 0.5, 2), 0)
+        self.assertEqual(repo.take_tokens(u'test', 0.5, 2), 0)
+
+        # Then we have to wait for the next token.
+        wait = repo.take_tokens(u'test', 0.5, 2)
+        self.assertTrue(0 < wait <= 2)
+
+        # The other buckets are unaffected.
+        self.assertEqual(repo.take_tokens(u'test:example.com', 0.5, 2), 0)
+
+        # Checking for a token leaves it in the bucket.
+        self.assertEqual(repo.take_tokens(u'test:peek', 0.5, 1, take=False), 0)
+        self.assertEqual(repo.take_tokens(u'test:peek', 0.5, 1, take=False), 0)
+        self.assertEqual(repo.take_tokens(u'test:peek', 0.5, 1), 0)
+
+    def test_mark_notifications_read(self):
+        """Test notifications are marked as read in bulk."""
+
+        factory = repo.BulkNotificationFactory(mock.Mock())
+
+        # Create an event and get it back.
+        context = model.factory()
+        event_id = boilerplate.createEvent(context)
+        event = te_repo.LookupActivityEvent()(event_id)
+
+        with transaction.manager:
+            user = boilerplate.createUser()
+            bm.Session.add(event)
+            notification_ids = [id_ for i in range(3)
+                    for id_ in factory(event, [user, user], DISPATCH_MAPPING)]
+            user_id = user.id
+
+        with transaction.manager:
+            # A list of them.
+            self.assertEqual(repo.mark_notifications_read(notification_ids[:1]), 1)
+            self.assertEqual(repo.mark_notifications_read(notification_ids[:1]), 0)
+
+            # Only the given user's.
+            self.assertEqual(repo.mark_notifications_read(notification_ids[1:2],
+                    user_id=user_id + 1), 0)
+
+            self.assertEqual(repo.get_unread_count(user_id), 2)
+
+            # All of the user's.
+            self.assertEqual(repo.mark_user_notifications_read(user_id), 2)
+            self.assertEqual(repo.mark_user_notifications_read(user_id), 0)
+            self.assertEqual(repo.get_unread_count(user_id), 0)
+
+            # Recounting leaves the count as it is.
+            repo.reconcile_unread_counts()
+            self.assertEqual(repo.get_unread_count(user_id), 0)
+
+    def test_inbox(self):
+        """Test paging through a user's notifications."""
+
+        factory = repo.BulkNotificationFactory(mock.Mock())
+        lookup = repo.LookupNotification()
+
+        # Create an event and get it back.
+        context = model.factory()
+        event_id = boilerplate.createEvent(context)
+        event = te_repo.LookupActivityEvent()(event_id)
+
+        with transaction.manager:
+            user = boilerplate.createUser()
+            bm.Session.add(event)
+            notification_ids = [id_ for i in range(5)
+                    for id_ in factory(event, [user], DISPATCH_MAPPING)]
+            repo.mark_notifications_read(notification_ids[:1])
+            user_id = user.id
+
+        with transaction.manager:
+            # Two pages of two and a last page of one.
+            first = lookup.inbox(user_id, 2)
+            last = first[-1]
+            second = lookup.inbox(user_id, 2, (last.created, last.id))
+            last = second[-1]
+            third = lookup.inbox(user_id, 2, (last.created, last.id))
+            ids = [x.id for x in first + second + third]
+            self.assertEqual(sorted(ids), sorted(notification_ids))
+            self.assertEqual(len(third), 1)
+
+            # Unread only.
+            self.assertEqual(len(lookup.inbox(user_id, 10, unread_only=True)), 4)
+            self.assertEqual(repo.get_unread_count(user_id), 4)
+
+            # Serialisable whether read or not.
+            self.assertTrue(all(x.__json__() for x in first + second + third))
+
+    def test_preference_cache(self):
+        """Test preferences are cached and dropped from the cache on update."""
+
+        lookup = repo.LookupNotificationPreference()
+
+        with transaction.manager:
+            user = boilerplate.createUser()
+            user_id = user.id
+            repo.update_notification_preferences(user_id, frequency=u'daily')
+            preference = lookup.get_many([user_id])[user_id]
+            self.assertEqual(preference.frequency, u'daily')
+            self.assertEqual(repo.preference_cache.get(user_id), preference)
+
+            # Updating drops the cached preference.
+            repo.update_notification_preferences(user_id, frequency=u'hourly')
+            self.assertIsNone(repo.preference_cache.get(user_id))
+            preference = lookup.get_many([user_id])[user_id]
+            self.assertEqual(preference.frequency, u'hourly')
+
+    def test_insert_notification_preferences(self):
+        """Test creating preferences that already exist skips them rather
+        than failing.
+        """
+
+        factory = repo.NotificationPreferencesFactory()
+
+        with transaction.manager:
+            users = [boilerplate.createUser(name=u'user{0}'.format(i)) for i in range(2)]
+            user_ids = [user.id for user in users]
+            repo.update_notification_preferences(user_ids[0], frequency=u'daily')
+
+            # Only the missing one is created.
+            self.assertEqual(repo.insert_notification_preferences(user_ids), user_ids[1:])
+            self.assertEqual(repo.insert_notification_preferences(user_ids), [])
+
+            # And the factory returns the existing preferences.
+            preference = factory(user_ids[0])
+            self.assertEqual(preference.frequency, u'daily')
@@ -0,0 +1,2 @@
+% if subject:
+${subject}
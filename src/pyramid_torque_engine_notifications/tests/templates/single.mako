@@ -0,0 +1 @@
+${subject}
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for rate limiting the channels and caching what they render."""
+
+import unittest
+
+import mock
+from repoze.lru import LRUCache
+
+from pyramid_torque_engine_notifications import channels
+
+
+class Bucket(object):
+    """Stands in for the token buckets in the db, refilled by the fake
+      sleeps rather than by the clock.
+    """
+
+    def __init__(self):
+        self.tokens = {}
+        self.slept = []
+
+    def take_tokens(self, key, rate, burst, count=1, take=True):
+        tokens = self.tokens.setdefault(key, burst)
+        if tokens >= count:
+            if take:
+                self.tokens[key] = tokens - count
+            return 0
+        return (count - tokens) / float(rate)
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        for key in self.tokens:
+            self.tokens[key] += seconds
+
+
+class TestRateLimiter(unittest.TestCase):
+    """Sends block for a token, or are deferred if it'd take too long."""
+
+    def setUp(self):
+        self.bucket = Bucket()
+
+    def make_limiter(self, rate, burst, max_wait, **kwargs):
+        return channels.RateLimiter(rate, burst, max_wait,
+                take_tokens=self.bucket.take_tokens, sleep=self.bucket.sleep, **kwargs)
+
+    def test_burst(self):
+        """Up to the burst is sent without waiting and the rest are paced."""
+
+        limiter = self.make_limiter(1, 3, 5)
+        for i in range(5):
+            limiter(u'sms')
+        self.assertEqual(self.bucket.slept, [1.0, 1.0])
+
+    def test_deferred(self):
+        """Sends that would wait for longer than the max wait raise."""
+
+        limiter = self.make_limiter(0.1, 1, 5)
+        limiter(u'sms')
+        self.assertRaises(channels.RateLimited, limiter, u'sms')
+        self.assertEqual(self.bucket.slept, [])
+
+    def test_no_wait(self):
+        """Sends are deferred rather than blocking by default."""
+
+        limiter = channels.RateLimiter(1, 1, take_tokens=self.bucket.take_tokens,
+                sleep=self.bucket.sleep)
+        limiter(u'sms')
+        self.assertRaises(channels.RateLimited, limiter, u'sms')
+        self.assertEqual(self.bucket.slept, [])
+
+    def test_peek(self):
+        """Waiting for a token without taking it leaves it in the bucket."""
+
+        limiter = self.make_limiter(1, 1, 5, take=False)
+        for i in range(3):
+            limiter(u'sms')
+        self.assertEqual(self.bucket.tokens[u'sms'], 1)
+        self.assertEqual(self.bucket.slept, [])
+
+    def test_deferred_spends_no_tokens(self):
+        """A message deferred by the channel's limit doesn't spend a token
+        of its recipient's domain."""
+
+        settings = {
+            'notification.channel.email.rate_limit': '1',
+            'notification.channel.email.domain_rate_limit': '1',
+        }
+        channel = channels.EmailChannel(settings, limiter_cls=self.make_limiter)
+        self.bucket.tokens[u'email'] = 0
+        message = {'to': u'joe@example.com'}
+        self.assertRaises(channels.RateLimited, channel.throttle, message)
+        self.assertEqual(self.bucket.tokens[u'email:example.com'], 1)
+
+        # Both are spent once there's a token for the channel.
+        self.bucket.tokens[u'email'] = 1
+        channel.throttle(message)
+        self.assertEqual(self.bucket.tokens[u'email'], 0)
+        self.assertEqual(self.bucket.tokens[u'email:example.com'], 0)
+
+    def test_domain(self):
+        """The domain of the recipient is found in the address."""
+
+        self.assertEqual(channels.get_domain(u'Joe <joe@Example.com>'), u'example.com')
+        self.assertIsNone(channels.get_domain(u'+441234567890'))
+
+
+class Email(object):
+    def __init__(self, to, bcc=None):
+        self.to = to
+        self.bcc = bcc
+
+
+class TestRenderCache(unittest.TestCase):
+    """Recipient independent emails are rendered once per event and spec."""
+
+    def setUp(self):
+        self.request = mock.Mock()
+        self.request.notification_render_cache = LRUCache(10)
+        self.request.render_email.side_effect = lambda f, to, *args, **kw: Email(to)
+        self.channel = channels.EmailChannel({})
+
+    def send(self, to, render_key):
+        message = {
+            'from': u'us@example.com',
+            'to': to,
+            'subject': u'X was COMPLETED',
+            'spec': 'templates/single.mako',
+            'tmpl_vars': {},
+            'render_key': render_key,
+        }
+        self.channel.send(self.request, message, [to])
+
+    def test_rendered_once(self):
+        """The email is rendered once and addressed to each recipient."""
+
+        for to in (u'a@example.com', u'b@example.com', u'c@example.com'):
+            self.send(to, (1, 'view', 'templates/single.mako'))
+        self.assertEqual(self.request.render_email.call_count, 1)
+        sent = [args[0].to for args, _ in self.request.notification_sender.call_args_list]
+        self.assertEqual(sent, [u'a@example.com', u'b@example.com', u'c@example.com'])
+
+    def test_not_cached(self):
+        """Emails without a render key are rendered for each recipient."""
+
+        self.send(u'a@example.com', None)
+        self.send(u'b@example.com', None)
+        self.assertEqual(self.request.render_email.call_count, 2)
+
+
+class TestGetNotificationChannel(unittest.TestCase):
+    """Dispatches of unregistered channels raise a specific error."""
+
+    def test_unknown_channel(self):
+        request = mock.Mock()
+        request.registry.notification_channels = {}
+        self.assertRaises(channels.UnknownChannel,
+                channels.get_notification_channel, request, 'pigeon')
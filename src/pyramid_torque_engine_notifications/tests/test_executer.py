@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for posting notification dispatches from the executer against a
+  local stand-in for the notification endpoint, and for keeping the daemon
+  running through failures.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import json
+import threading
+import time
+import unittest
+
+import mock
+
+from pyramid_torque_engine_notifications import notification_executer
+
+# Simulated latency of the endpoint, in seconds.
+LATENCY = 0.05
+# Dispatch ids the endpoint fails to send.
+FAILING_IDS = set([3, 7])
+
+
+class EndpointHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Stands in for the ``/notifications/single`` endpoint."""
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length'))
+        data = json.loads(self.rfile.read(length))
+        time.sleep(LATENCY)
+        status = 500 if data['notification_dispatch_id'] in FAILING_IDS else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestNotificationDispatchPoster(unittest.TestCase):
+    """Post dispatch ids concurrently and collect the failures."""
+
+    @classmethod
+    def setup_class(cls):
+        cls.server = ThreadedHTTPServer(('127.0.0.1', 0), EndpointHandler)
+        cls.endpoint = 'http://127.0.0.1:{0}/notifications/single'.format(
+                cls.server.server_address[1])
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.server.shutdown()
+
+    def post(self, dispatch_ids, concurrency):
+        poster = notification_executer.NotificationDispatchPoster(self.endpoint,
+                concurrency, api_key='a' * 40, header_names=['api_key'])
+        start = time.time()
+        try:
+            failed = poster(dispatch_ids)
+        finally:
+            poster.close()
+        return failed, time.time() - start
+
+    def test_failures_are_collected(self):
+        """The ids the endpoint failed to send are returned for retry."""
+
+        failed, _ = self.post(range(10), 5)
+        self.assertEqual(sorted(failed), sorted(FAILING_IDS))
+
+    def test_concurrency_speedup(self):
+        """Posting through the pool is faster than posting serially."""
+
+        dispatch_ids = range(100, 140)
+        _, serial = self.post(dispatch_ids, 1)
+        _, concurrent = self.post(dispatch_ids, 10)
+        self.assertTrue(concurrent * 3 < serial)
+
+    def test_channels(self):
+        """Each channel is posted through a poster of its own."""
+
+        throttled = []
+
+        class Limiter(object):
+            def __init__(self, rate, max_wait, take):
+                self.take = take
+            def __call__(self, key):
+                throttled.append((key, self.take))
+
+        def poster_cls(concurrency, throttle):
+            return notification_executer.NotificationDispatchPoster(self.endpoint,
+                    concurrency, api_key='a' * 40, header_names=['api_key'],
+                    throttle=throttle)
+        poster = notification_executer.ChannelDispatchPoster(poster_cls=poster_cls,
+                limiter_cls=Limiter)
+        items = [('email', 1), ('sms', 3), ('email', 7), ('webhook', 8)]
+        try:
+            failed = poster(items)
+        finally:
+            poster.close()
+        self.assertEqual(sorted(failed), [('email', 7), ('sms', 3)])
+        self.assertEqual(sorted(poster.posters), ['email', 'sms', 'webhook'])
+
+        # Only the rate limited channel waited, leaving the tokens to the endpoint.
+        self.assertEqual(throttled, [('sms', False)])
+
+
+class TestServe(unittest.TestCase):
+    """The daemon keeps going when dispatching or listening fails."""
+
+    def test_recovers(self):
+        stopping = []
+        calls = []
+
+        def dispatch():
+            calls.append(None)
+            if len(calls) == 1:
+                raise Exception('Boom')
+            stopping.append(True)
+            return True
+
+        engine = mock.Mock()
+        engine.raw_connection.side_effect = Exception('Database is down')
+        with mock.patch.object(notification_executer, 'NOTIFICATION_POLL_MIN', 0.01):
+            notification_executer.serve(engine, dispatch, stopping)
+
+        # It dispatched again after the failure, listening each time round.
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(engine.raw_connection.call_count, 2)
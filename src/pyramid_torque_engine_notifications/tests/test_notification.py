@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for checking the dispatch mappings up front and memoizing the
+  interested users.
+"""
+
+import unittest
+
+import mock
+
+from pyramid import config as pyramid_config
+from pyramid import exceptions
+
+from pyramid_torque_engine_notifications import notification as n
+
+
+class IContext(object):
+    """Stands in for a resource interface."""
+
+
+class Context(object):
+    """Stands in for a resource with a work status."""
+
+    def __init__(self, id, work_status):
+        self.id = id
+        self.work_status = work_status
+
+
+def dummy_view(request, context, send_to, event, action):
+    return {}
+
+
+class TestWarmDispatchMapping(unittest.TestCase):
+    """Unknown views and templates fail when the configuration is committed."""
+
+    def setUp(self):
+        self.config = pyramid_config.Configurator(settings={})
+
+    def test_bad_view(self):
+        mapping = {
+            'email': {
+                'view': __name__ + '.missing_view',
+                'single': None,
+                'batch': None,
+            },
+        }
+        n.warm_dispatch_mapping(self.config, mapping)
+        self.assertRaises(exceptions.ConfigurationError, self.config.commit)
+
+    def test_bad_template(self):
+        mapping = {
+            'email': {
+                'view': __name__ + '.dummy_view',
+                'single': 'pyramid_torque_engine_notifications:templates/missing.mako',
+                'batch': None,
+            },
+        }
+        n.warm_dispatch_mapping(self.config, mapping)
+        self.assertRaises(exceptions.ConfigurationError, self.config.commit)
+
+    def test_mako_template(self):
+        self.config.include('pyramid_mako')
+        mapping = {
+            'email': {
+                'view': __name__ + '.dummy_view',
+                'single': 'pyramid_torque_engine_notifications.tests:templates/single.mako',
+                'batch': None,
+            },
+        }
+        n.warm_dispatch_mapping(self.config, mapping)
+        self.config.commit()
+
+    def test_broken_mako_template(self):
+        self.config.include('pyramid_mako')
+        mapping = {
+            'email': {
+                'view': __name__ + '.dummy_view',
+                'single': 'pyramid_torque_engine_notifications.tests:templates/broken.mako',
+                'batch': None,
+            },
+        }
+        n.warm_dispatch_mapping(self.config, mapping)
+        self.assertRaises(exceptions.ConfigurationError, self.config.commit)
+
+    def test_no_templates(self):
+        mapping = {
+            'in_app': {
+                'view': __name__ + '.dummy_view',
+                'single': None,
+                'batch': None,
+            },
+        }
+        n.warm_dispatch_mapping(self.config, mapping)
+        self.config.commit()
+
+
+class TestInterestedUsers(unittest.TestCase):
+    """The interested users are looked up once per context and state."""
+
+    def setUp(self):
+        self.roles = mock.Mock(return_value=[1, 2])
+        self.request = mock.Mock()
+        self.request.environ = {}
+        self.request.registry.roles_mapping = {IContext: self.roles}
+
+    def test_repeat_lookup_is_cached(self):
+        context = Context(1, u'started')
+        first = n.get_interested_users(self.request, IContext, context)
+        second = n.get_interested_users(self.request, IContext, context)
+        self.assertEqual(first, [1, 2])
+        self.assertEqual(second, [1, 2])
+        self.assertEqual(self.roles.call_count, 1)
+
+    def test_change_of_state_invalidates(self):
+        context = Context(1, u'started')
+        n.get_interested_users(self.request, IContext, context)
+        context.work_status = u'completed'
+        self.roles.return_value = [3]
+        users = n.get_interested_users(self.request, IContext, context)
+        self.assertEqual(users, [3])
+        self.assertEqual(self.roles.call_count, 2)
+
+    def test_other_contexts_are_looked_up(self):
+        n.get_interested_users(self.request, IContext, Context(1, u'started'))
+        n.get_interested_users(self.request, IContext, Context(2, u'started'))
+        self.assertEqual(self.roles.call_count, 2)
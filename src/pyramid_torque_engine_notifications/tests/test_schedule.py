@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for working out when notifications are due."""
+
+import collections
+import datetime
+import unittest
+
+from dateutil import tz
+
+from pyramid_torque_engine_notifications import schedule
+
+
+class TestScheduler(unittest.TestCase):
+    """Due dates roll over days, months and quiet hours."""
+
+    def setUp(self):
+        self.utc = tz.tzutc()
+        self.scheduler = schedule.Scheduler(default_tz=self.utc, spread={})
+
+    def as_utc(self, value):
+        return value.replace(tzinfo=tz.tzlocal()).astimezone(self.utc).replace(tzinfo=None)
+
+    def test_daily_at_month_end(self):
+        """Daily notifications after the daily hour are due tomorrow."""
+
+        now = datetime.datetime(2015, 1, 31, 21, tzinfo=self.utc)
+        due = self.scheduler.due('daily', timezone='UTC', now=now)
+        self.assertEqual(self.as_utc(due), datetime.datetime(2015, 2, 1, 20))
+
+    def test_hourly_at_day_end(self):
+        """Hourly notifications at 23h are due at midnight."""
+
+        now = datetime.datetime(2015, 12, 31, 23, 30, tzinfo=self.utc)
+        due = self.scheduler.due('hourly', timezone='UTC', now=now)
+        self.assertEqual(self.as_utc(due), datetime.datetime(2016, 1, 1, 0))
+
+    def test_quiet_hours(self):
+        """Notifications due in the quiet hours wait until they end."""
+
+        scheduler = schedule.Scheduler(default_tz=self.utc, spread={},
+                quiet_hours=(22, 7))
+        now = datetime.datetime(2015, 1, 31, 23, tzinfo=self.utc)
+        due = scheduler.due(None, timezone='UTC', now=now)
+        self.assertEqual(self.as_utc(due), datetime.datetime(2015, 2, 1, 7))
+
+    def test_schedule(self):
+        """Recipients are mapped to the due date of their preferences."""
+
+        now = datetime.datetime(2015, 1, 31, 12, 15, tzinfo=self.utc)
+        due_dates = self.scheduler.schedule([(1, 'daily', 'UTC'),
+                (2, 'hourly', 'UTC'), (3, 'daily', 'UTC')], now=now)
+        self.assertEqual(due_dates[1], due_dates[3])
+        self.assertEqual(self.as_utc(due_dates[2]), datetime.datetime(2015, 1, 31, 13))
+
+
+class TestSpread(unittest.TestCase):
+    """Due dates are spread over a window, at the same time for each user."""
+
+    def setUp(self):
+        self.utc = tz.tzutc()
+
+    def peak(self, scheduler, user_ids, now):
+        """The most recipients due in the same minute."""
+
+        recipients = [(user_id, 'daily', 'UTC') for user_id in user_ids]
+        due_dates = scheduler.schedule(recipients, now=now)
+        per_minute = collections.Counter(due.replace(second=0, microsecond=0)
+                for due in due_dates.values())
+        return max(per_minute.values())
+
+    def test_peak_reduction(self):
+        """Simulate a day of daily digests: spread over an hour, the peak
+        rate is a small fraction of everybody at once."""
+
+        user_ids = range(1, 10001)
+        now = datetime.datetime(2015, 1, 31, 12, tzinfo=self.utc)
+        spiky = schedule.Scheduler(default_tz=self.utc, spread={})
+        spread = schedule.Scheduler(default_tz=self.utc, spread={'daily': 60})
+        self.assertEqual(self.peak(spiky, user_ids, now), 10000)
+        self.assertTrue(self.peak(spread, user_ids, now) < 10000 / 40)
+
+    def test_stable(self):
+        """A user's digest is due at the same time of day, every day, within
+        the window."""
+
+        scheduler = schedule.Scheduler(default_tz=self.utc, spread={'daily': 60})
+        now = datetime.datetime(2015, 1, 31, 12, tzinfo=self.utc)
+        today = scheduler.due('daily', timezone='UTC', now=now, user_id=42)
+        tomorrow = scheduler.due('daily', timezone='UTC',
+                now=now + datetime.timedelta(days=1), user_id=42)
+        self.assertEqual(tomorrow - today, datetime.timedelta(days=1))
+        start = datetime.datetime(2015, 1, 31, 20, tzinfo=self.utc)
+        due = today.replace(tzinfo=tz.tzlocal()).astimezone(self.utc)
+        self.assertTrue(start <= due < start + datetime.timedelta(hours=1))
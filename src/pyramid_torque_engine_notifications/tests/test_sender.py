@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for sending emails through a local stand-in for the Postmark
+  batch API.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import json
+import threading
+import unittest
+
+import mock
+
+from pyramid_torque_engine_notifications import sender
+
+
+class PostmarkHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Stands in for the Postmark ``/email/batch`` endpoint, rejecting the
+      messages sent to ``bad@example.com``.
+    """
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length'))
+        messages = json.loads(self.rfile.read(length))
+        self.server.batches.append(messages)
+        results = []
+        for message in messages:
+            if message['To'] == 'bad@example.com':
+                results.append({'ErrorCode': 300, 'Message': 'Invalid email',
+                        'To': message['To']})
+            else:
+                results.append({'ErrorCode': 0, 'Message': 'OK',
+                        'To': message['To']})
+        body = json.dumps(results)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class Email(object):
+    """Provides the ``to_json_message`` api of a ``postmark.PMMail``."""
+
+    def __init__(self, to):
+        self.to = to
+
+    def to_json_message(self):
+        return {'From': 'test@example.com', 'To': self.to, 'Subject': 'Hi'}
+
+
+class TestPostmarkBatchSender(unittest.TestCase):
+    """Emails are sent in batches and the results mapped to the dispatches."""
+
+    @classmethod
+    def setup_class(cls):
+        cls.server = ThreadedHTTPServer(('127.0.0.1', 0), PostmarkHandler)
+        cls.url = 'http://127.0.0.1:{0}/email/batch'.format(
+                cls.server.server_address[1])
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        self.server.batches = []
+        self.request = mock.Mock()
+        self.request.registry.settings = {
+            'notification.postmark_batch_url': self.url,
+            'notification.batch_size': 2,
+            'postmark.api_key': 'key',
+        }
+        self.mark_sent = mock.Mock()
+        self.mark_failed = mock.Mock()
+
+    def test_batching(self):
+        """Emails are sent once the batch is full and when flushed."""
+
+        email_sender = sender.PostmarkBatchSender(self.request,
+                mark_sent=self.mark_sent, mark_failed=self.mark_failed)
+        for to in ('a@example.com', 'b@example.com', 'c@example.com'):
+            email_sender(Email(to), [to])
+        self.assertEqual(len(self.server.batches), 1)
+        self.assertEqual(len(self.server.batches[0]), 2)
+
+        failed = email_sender.flush()
+        self.assertEqual(failed, [])
+        self.assertEqual(len(self.server.batches), 2)
+        self.assertEqual(len(self.server.batches[1]), 1)
+        self.assertEqual(self.mark_sent.call_count, 2)
+
+    def test_partial_failure(self):
+        """Only the dispatches of the accepted emails are marked as sent and
+        the failures of the others are recorded."""
+
+        email_sender = sender.PostmarkBatchSender(self.request,
+                mark_sent=self.mark_sent, mark_failed=self.mark_failed)
+        email_sender(Email('bad@example.com'), ['bad'])
+        email_sender(Email('good@example.com'), ['good'])
+
+        self.assertEqual(len(self.server.batches), 1)
+        self.mark_sent.assert_called_once_with(['good'])
+        self.mark_failed.assert_called_once_with([('bad', 'Invalid email')])
+        self.assertEqual(email_sender.flush(), ['bad'])